@@ -3,12 +3,14 @@ import logging
 import asyncio
 import re
 import traceback
+from collections import OrderedDict
+from typing import Awaitable, Optional
 
 from telegram import Update
 from telegram.constants import ParseMode
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler, ConversationHandler, ContextTypes,
-    PicklePersistence
+    PicklePersistence, BaseUpdateProcessor, AIORateLimiter
 )
 
 import config
@@ -93,6 +95,91 @@ async def ptb_error_handler(update: object, context: ContextTypes.DEFAULT_TYPE)
         logger.warning("ADMIN_TELEGRAM_IDS list is empty in config. Cannot send error notifications.")
 
 
+# --- Update Processor ---
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates from different chats concurrently while keeping the updates
+    of a single chat strictly in order (one at a time per chat).
+
+    An update first waits for its chat's lock and only then for one of the
+    `max_concurrent_updates` slots, so updates queued behind their own chat hold no slot
+    and a flood from one chat cannot stall the others. PTB's process_update would take
+    the slot first, so it is overridden with a semaphore of our own.
+    """
+    MAX_TRACKED_CHATS = 4096
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._chat_locks: OrderedDict[int, asyncio.Lock] = OrderedDict()
+        # Updates per chat that are running or waiting for the chat's lock. A chat's lock may
+        # only be evicted at zero: lock.locked() is briefly False while a woken waiter is
+        # about to take it over, and a fresh lock then would let the next update overtake it.
+        self._chat_pending: dict[int, int] = {}
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._running = 0
+
+    @property
+    def current_concurrent_updates(self) -> int:
+        return self._running
+
+    def _get_chat_lock(self, chat_id: int) -> asyncio.Lock:
+        lock = self._chat_locks.get(chat_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._chat_locks[chat_id] = lock
+            # Evict least recently used chats with no update in flight, oldest first
+            excess = len(self._chat_locks) - self.MAX_TRACKED_CHATS
+            if excess > 0:
+                idle_chat_ids = []
+                for old_chat_id in self._chat_locks:
+                    if old_chat_id not in self._chat_pending:
+                        idle_chat_ids.append(old_chat_id)
+                        if len(idle_chat_ids) == excess:
+                            break
+                for old_chat_id in idle_chat_ids:
+                    del self._chat_locks[old_chat_id]
+        else:
+            self._chat_locks.move_to_end(chat_id)
+        return lock
+
+    async def process_update(self, update: object, coroutine: Awaitable) -> None:
+        chat_id: Optional[int] = None
+        if isinstance(update, Update) and update.effective_chat:
+            chat_id = update.effective_chat.id
+        if chat_id is None:
+            # Updates without a chat (e.g. inline queries) have no ordering to preserve
+            await self._process_in_slot(update, coroutine)
+            return
+        # Counted before taking the lock, so this chat can't be evicted while the update waits
+        self._chat_pending[chat_id] = self._chat_pending.get(chat_id, 0) + 1
+        try:
+            async with self._get_chat_lock(chat_id):
+                await self._process_in_slot(update, coroutine)
+        finally:
+            remaining = self._chat_pending[chat_id] - 1
+            if remaining:
+                self._chat_pending[chat_id] = remaining
+            else:
+                del self._chat_pending[chat_id]
+
+    async def _process_in_slot(self, update: object, coroutine: Awaitable) -> None:
+        async with self._slots:
+            self._running += 1
+            try:
+                await self.do_process_update(update, coroutine)
+            finally:
+                self._running -= 1
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._chat_locks.clear()
+        self._chat_pending.clear()
+
 
 class TelegramBot:
     """Encapsulates the Telegram Bot Application and its execution."""
@@ -103,7 +190,17 @@ class TelegramBot:
             raise ValueError("Invalid Telegram Bot Token provided.")
         logger.info("Initializing Telegram Bot Class...")
         self.token = token
-        builder = Application.builder().token(self.token)
+        builder = (
+            Application.builder()
+            .token(self.token)
+            .connection_pool_size(config.BOT_CONNECTION_POOL_SIZE)
+            .pool_timeout(config.BOT_POOL_TIMEOUT)
+            .concurrent_updates(PerChatUpdateProcessor(config.BOT_MAX_CONCURRENT_UPDATES))
+            .rate_limiter(AIORateLimiter(
+                overall_max_rate=config.BOT_RATE_LIMIT_OVERALL_MAX_RATE,
+                max_retries=config.BOT_RATE_LIMIT_MAX_RETRIES,
+            ))
+        )
 
         persistence = PicklePersistence(filepath=config.BOT_PERSISTENCE_FILEPATH)
         builder.persistence(persistence)
@@ -208,12 +305,12 @@ class TelegramBot:
 
             # Initial Buy Button press
             self.application.add_handler(CallbackQueryHandler(
-                handlers.handle_purchase_button, pattern=r'^buy_listing_\d+$'
+                handlers.handle_purchase_button, pattern=handlers.BUY_LISTING_PATTERN
             ), group=1)
 
             # Buyer Confirmation
             self.application.add_handler(CallbackQueryHandler(
-                handlers.handle_confirm_purchase, pattern=r'^confirm_buy_\d+$'
+                handlers.handle_confirm_purchase, pattern=handlers.CONFIRM_BUY_PATTERN
             ), group=1)
 
             # Buyer Cancellation
@@ -221,18 +318,18 @@ class TelegramBot:
                 handlers.handle_cancel_purchase, pattern=r'^cancel_buy$'
             ), group=1)
             self.application.add_handler(CallbackQueryHandler(  # Buyer cancels AFTER confirming and seeing seller details
-                    handlers.handle_buyer_cancel_pending, pattern=fr'^{handlers.CALLBACK_BUYER_CANCEL_PENDING}_\d+$'
+                    handlers.handle_buyer_cancel_pending, pattern=handlers.BUYER_CANCEL_PENDING_PATTERN
             ), group=1)
 
 
             # Seller Confirmation
             self.application.add_handler(CallbackQueryHandler(
-                handlers.handle_seller_confirmation, pattern=r'^seller_confirm_\d+$'
+                handlers.handle_seller_confirmation, pattern=handlers.SELLER_CONFIRM_PATTERN
             ), group=1)
 
             # Seller Rejection
             self.application.add_handler(CallbackQueryHandler(  # Seller rejects/cancels pending purchase
-                handlers.handle_seller_reject_pending, pattern=fr'^{handlers.CALLBACK_SELLER_REJECT_PENDING}_\d+$'
+                handlers.handle_seller_reject_pending, pattern=handlers.SELLER_REJECT_PENDING_PATTERN
             ), group=1)
 
             # Settings Flow Callback
@@ -246,14 +343,14 @@ class TelegramBot:
             ), group=1)
 
             self.application.add_handler(CallbackQueryHandler(
-                handlers.handle_history_view, pattern=r'^history_(purchases|sales)_\d+$'
+                handlers.handle_history_view, pattern=handlers.HISTORY_VIEW_PATTERN
             ), group=1)
             self.application.add_handler(CallbackQueryHandler(
                 handlers.handle_history_back_select, pattern=r'^history_back_select$'
             ), group=1)
-            # Handler for no-operation page number button
+            # Handler for no-operation page number button (non-blocking: it only acknowledges the callback)
             self.application.add_handler(CallbackQueryHandler(
-                lambda update, context: update.callback_query.answer(), pattern=r'^history_noop$'
+                lambda update, context: update.callback_query.answer(), pattern=r'^history_noop$', block=False
             ), group=1)
 
             admin_handler_group = 10  # Using a new group for admin commands
@@ -264,16 +361,21 @@ class TelegramBot:
             self.application.add_handler(CommandHandler("getuser", handlers.get_user_info), group=admin_handler_group)
             self.application.add_handler(CommandHandler("listusers", handlers.list_users_command),
                                          group=admin_handler_group)
+            # Pagination and no-op callbacks don't touch user_data, so they may run without blocking later updates
             self.application.add_handler(CallbackQueryHandler(handlers.list_users_callback,
-                                                              pattern=f"^{handlers.CALLBACK_ADMIN_LIST_USERS_PAGE}\\d+$"),
+                                                              pattern=f"^{handlers.CALLBACK_ADMIN_LIST_USERS_PAGE}\\d+$",
+                                                              block=False),
                                          group=admin_handler_group)
-            self.application.add_handler(CallbackQueryHandler(handlers.admin_noop_callback, pattern=r'^admin_noop$'),
+            self.application.add_handler(CallbackQueryHandler(handlers.admin_noop_callback, pattern=r'^admin_noop$',
+                                                              block=False),
                                          group=admin_handler_group)
 
             self.application.add_handler(CommandHandler("delmeal", handlers.delete_meal_command),
                                          group=admin_handler_group)
             self.application.add_handler(CommandHandler("dellisting", handlers.delete_listing_command),
                                          group=admin_handler_group)
+            self.application.add_handler(CommandHandler("dbpool", handlers.db_pool_status_command),
+                                         group=admin_handler_group)
 
             # Generic Text Handler (Group 2)
             # self.application.add_handler(MessageHandler(
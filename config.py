@@ -22,6 +22,8 @@ if ADMIN_TELEGRAM_IDS_STR:
     except ValueError:
         print("ERROR: Invalid ADMIN_TELEGRAM_IDS in .env file. Should be comma-separated integers.")
         ADMIN_TELEGRAM_IDS = []
+# Same IDs as a frozenset, for O(1) membership checks on every admin command/callback
+ADMIN_TELEGRAM_ID_SET: frozenset[int] = frozenset(ADMIN_TELEGRAM_IDS)
 
 # --- Logging ---
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
@@ -31,6 +33,7 @@ LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 # How many items to show per page in history view
 HISTORY_PAGE_SIZE: int = 5
 USERS_LIST_PAGE_SIZE: int = 20  # How many items to show per page in admin users list `/userslist`
+BUY_LIST_MAX_LISTINGS: int = 15  # Most listings shown in the 'Buy Food' list (keeps it under Telegram's 4096-char limit)
 # How long (in minutes) a listing can stay in AWAITING_CONFIRMATION before timeout
 PENDING_TIMEOUT_MINUTES: int = int(os.environ.get("PENDING_TIMEOUT_MINUTES", "1440"))
 
@@ -43,6 +46,28 @@ BACKGROUND_MEALS_UPDATE_CHECK_INTERVAL_MINUTES : int = int(os.environ.get("MEALS
 # Default price limit for undefined meals
 DEFAULT_PRICE_LIMIT: int = int(os.environ.get("DEFAULT_PRICE_LIMIT", "25000"))
 
+# --- Bot API HTTP client ---
+# Connections shared by all outgoing Bot API calls (send/edit/answer), and how long (in seconds)
+# a call may wait for a free connection before failing
+BOT_CONNECTION_POOL_SIZE: int = int(os.environ.get("BOT_CONNECTION_POOL_SIZE", "256"))
+BOT_POOL_TIMEOUT: float = float(os.environ.get("BOT_POOL_TIMEOUT", "5"))
+# Outgoing calls are paced to Telegram's global limit (calls per second) instead of running into 429s;
+# calls that still get a 429 are retried after the server-given delay, at most this many times
+BOT_RATE_LIMIT_OVERALL_MAX_RATE: float = float(os.environ.get("BOT_RATE_LIMIT_OVERALL_MAX_RATE", "30"))
+BOT_RATE_LIMIT_MAX_RETRIES: int = int(os.environ.get("BOT_RATE_LIMIT_MAX_RETRIES", "3"))
+
+# --- Database connection pool ---
+# Updates from different chats run concurrently (see BOT_MAX_CONCURRENT_UPDATES), and almost every
+# interaction opens a DB session; size the pool for bursts instead of SQLAlchemy's default of 5 + 10 overflow
+DB_POOL_SIZE: int = int(os.environ.get("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW: int = int(os.environ.get("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT: float = float(os.environ.get("DB_POOL_TIMEOUT", "10"))  # Seconds to wait for a free connection
+
+# --- Update processing ---
+# Updates from different chats are handled concurrently (at most this many at once);
+# updates from the same chat are still handled one at a time, in order
+BOT_MAX_CONCURRENT_UPDATES: int = int(os.environ.get("BOT_MAX_CONCURRENT_UPDATES", "64"))
+
 # TODO: Add other configurable items here later (e.g., price limits, messages)
 
 # --- Bot messages ---
@@ -46,6 +46,8 @@ __all__ = [
     'handle_confirm_purchase', 'handle_cancel_purchase',
     'handle_buyer_cancel_pending', 'handle_seller_reject_pending',
     'handle_seller_confirmation',
+    'BUY_LISTING_PATTERN', 'CONFIRM_BUY_PATTERN', 'BUYER_CANCEL_PENDING_PATTERN',
+    'SELLER_REJECT_PENDING_PATTERN', 'SELLER_CONFIRM_PATTERN',
 
     # Listings Management Handlers
     'handle_my_listings', 'handle_cancel_available_listing_button',
@@ -57,12 +59,13 @@ __all__ = [
 
     # History Handlers
     'handle_history', 'handle_history_view', 'handle_history_back_select',
+    'HISTORY_VIEW_PATTERN',
 
     # Admin Handlers
     'set_admin_status', 'set_active_status', 'get_user_info',
     'list_users_command', 'list_users_callback', 'admin_noop_callback', # Added admin_noop_callback
     'add_meal_conv_handler', # Add the conversation handler itself
-    'delete_meal_command', 'delete_listing_command',
+    'delete_meal_command', 'delete_listing_command', 'db_pool_status_command',
     # Add conversation states for admin if they need to be globally accessible for some reason, usually not.
     # 'ADDMEAL_ASK_DESCRIPTION', 'ADDMEAL_ASK_TYPE', etc.
     # Add callback data constants for admin if needed globally
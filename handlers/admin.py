@@ -1,25 +1,28 @@
 import logging
+import re
+import time
 from functools import wraps
-from decimal import Decimal, InvalidOperation
 from datetime import date as GregorianDate # Alias to avoid conflict with datetime.date
 from datetime import datetime
 import jdatetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
 from telegram.ext import (
     ContextTypes,
     ConversationHandler,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
     filters,
 )
 from telegram.constants import ParseMode
-from config import ADMIN_TELEGRAM_IDS, HISTORY_PAGE_SIZE, \
+from config import ADMIN_TELEGRAM_ID_SET, HISTORY_PAGE_SIZE, \
     USERS_LIST_PAGE_SIZE  # Using HISTORY_PAGE_SIZE for user list pagination for now
-from self_market.db.session import get_db_session
+from self_market.db.session import get_db_session, get_pool_status
 from self_market.db import crud
 from self_market import models
 from utility import escape_markdown_v2, format_gregorian_date_to_shamsi
+from .common import RenderedMessageCache
 
 logger = logging.getLogger(__name__)
 
@@ -28,7 +31,7 @@ def admin_required(func):
     @wraps(func)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
         user = update.effective_user
-        if not user or user.id not in ADMIN_TELEGRAM_IDS:
+        if not user or user.id not in ADMIN_TELEGRAM_ID_SET:
             logger.warning(f"Unauthorized admin command attempt by {user.id if user else 'Unknown User'}.")
             if update.callback_query:
                 await update.callback_query.answer("شما مجاز به استفاده از این دستور نیستید.", show_alert=True)
@@ -58,6 +61,57 @@ CALLBACK_ADDMEAL_TYPE_PREFIX = "addmeal_type_"
 CALLBACK_ADDMEAL_TYPE_NAHAR = f"{CALLBACK_ADDMEAL_TYPE_PREFIX}ناهار" # Lunch
 CALLBACK_ADDMEAL_TYPE_SHAM = f"{CALLBACK_ADDMEAL_TYPE_PREFIX}شام"   # Dinner
 
+# Compiled callback patterns for the /addmeal conversation
+ADDMEAL_TYPE_PATTERN = re.compile(f"^{CALLBACK_ADDMEAL_TYPE_PREFIX}(ناهار|شام)$")
+ADDMEAL_CONFIRM_PATTERN = re.compile(f"^({CALLBACK_ADMIN_MEAL_CONFIRM_YES}|{CALLBACK_ADMIN_MEAL_CONFIRM_NO})$")
+
+# Static /addmeal keyboards, built once at import time
+ADDMEAL_TYPE_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("ناهار 🍚", callback_data=CALLBACK_ADDMEAL_TYPE_NAHAR),
+        InlineKeyboardButton("شام 🌙", callback_data=CALLBACK_ADDMEAL_TYPE_SHAM),
+    ]
+])
+ADDMEAL_CONFIRM_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("✅ بله، اضافه کن", callback_data=CALLBACK_ADMIN_MEAL_CONFIRM_YES),
+        InlineKeyboardButton("❌ خیر، لغو کن", callback_data=CALLBACK_ADMIN_MEAL_CONFIRM_NO),
+    ]
+])
+
+# Shamsi date input (YYYY/MM/DD). \d also matches Persian digits, which int() understands.
+ADDMEAL_DATE_PATTERN = re.compile(r'^(\d{4})/(\d{1,2})/(\d{1,2})$')
+
+# How long (in seconds) the cached Shamsi "today" is reused
+JALALI_TODAY_CACHE_SECONDS = 60
+_jalali_today_cache: tuple[float, jdatetime.date] | None = None
+
+def _jalali_today() -> jdatetime.date:
+    """Returns jdatetime.date.today(), recomputed at most once per JALALI_TODAY_CACHE_SECONDS."""
+    global _jalali_today_cache
+    now = time.monotonic()
+    if _jalali_today_cache is None or now - _jalali_today_cache[0] >= JALALI_TODAY_CACHE_SECONDS:
+        _jalali_today_cache = (now, jdatetime.date.today())
+    return _jalali_today_cache[1]
+
+# Keys the /addmeal conversation keeps in context.user_data (persisted by PicklePersistence)
+ADDMEAL_USER_DATA_KEYS = (
+    'addmeal_description',
+    'addmeal_type',
+    'addmeal_date',
+    'addmeal_price',
+    'addmeal_price_limit',
+)
+
+def _clear_addmeal_user_data(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Removes only the /addmeal keys from user_data, leaving state owned by other features intact."""
+    for key in ADDMEAL_USER_DATA_KEYS:
+        context.user_data.pop(key, None)
+
+# Hash of the last /listusers page rendered into each (chat_id, message_id), to skip no-op edits
+LIST_USERS_RENDER_CACHE_SIZE = 2048
+_list_users_last_render = RenderedMessageCache(LIST_USERS_RENDER_CACHE_SIZE)
+
 # User Management Handlers
 @admin_required
 async def set_admin_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -162,6 +216,15 @@ async def get_user_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     else:
         await message.reply_text(f"کاربر با آیدی تلگرام {target_user_tg_id} یافت نشد\\.", parse_mode=ParseMode.MARKDOWN_V2)
 
+def _user_status_icons(u: models.User) -> str:
+    """Returns the space-separated status icons shown next to a user in /listusers."""
+    icons = (
+        ("👑", u.is_admin),       # Admin
+        ("✅", u.is_verified),    # Verified
+        ("🚫", not u.is_active),  # Disabled icon
+    )
+    return " ".join(icon for icon, shown in icons if shown)
+
 async def _send_list_users_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 0):
     query = update.callback_query
     message = update.message or (query.message if query else None)
@@ -175,19 +238,13 @@ async def _send_list_users_page(update: Update, context: ContextTypes.DEFAULT_TY
         reply_markup = None
     else:
         # Escape literal parentheses for MARKDOWN_V2
-        text_parts = [f"*لیست کاربران \\(صفحه {page + 1}\\)*\n"]
-        for u in users:
-            status_icons = []
-            if u.is_admin: status_icons.append("👑") # Admin
-            if u.is_verified: status_icons.append("✅") # Verified
-            if not u.is_active: status_icons.append("🚫") # Disabled icon
-
-            status_str = " ".join(status_icons)
+        lines = [f"*لیست کاربران \\(صفحه {page + 1}\\)*\n"]
+        lines.extend(
             # FIX: Escape literal parentheses for MARKDOWN_V2
-            text_parts.append(
-                f"`{u.telegram_id}`: @{escape_markdown_v2(u.username or 'N/A')} \\({escape_markdown_v2(u.first_name or 'N/A')}\\) {status_str}"
-            )
-        text = "\n".join(text_parts)
+            f"`{u.telegram_id}`: @{escape_markdown_v2(u.username or 'N/A')} \\({escape_markdown_v2(u.first_name or 'N/A')}\\) {_user_status_icons(u)}"
+            for u in users
+        )
+        text = "\n".join(lines)
 
         total_pages = (total_count + USERS_LIST_PAGE_SIZE - 1) // USERS_LIST_PAGE_SIZE
         keyboard_buttons = []
@@ -203,10 +260,18 @@ async def _send_list_users_page(update: Update, context: ContextTypes.DEFAULT_TY
         reply_markup = InlineKeyboardMarkup(keyboard_buttons) if keyboard_buttons else None
 
     if query:
+        render_key = (message.chat_id, message.message_id)
+        render_hash = RenderedMessageCache.render_hash(text, reply_markup)
+        if _list_users_last_render.is_shown(*render_key, render_hash):
+            # Same page already shown in this message; skip the Bot API round-trip
+            logger.debug(f"list_users page {page} unchanged for message {render_key}, skipping edit.")
+            return
         try:
             await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN_V2)
+            _list_users_last_render.remember(*render_key, render_hash)
         except Exception as e: # Handle cases where message content is unchanged
             if "Message is not modified" in str(e):
+                _list_users_last_render.remember(*render_key, render_hash)
                 await query.answer("صفحه تغییری نکرده است.")
             else:
                 logger.error(f"Error editing message for list_users: {e}", exc_info=True)
@@ -227,7 +292,7 @@ async def list_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def list_users_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
-    page = int(query.data.split(CALLBACK_ADMIN_LIST_USERS_PAGE)[1])
+    page = int(query.data.partition(CALLBACK_ADMIN_LIST_USERS_PAGE)[2])
     await _send_list_users_page(update, context, page=page)
 
 @admin_required
@@ -251,15 +316,7 @@ async def add_meal_receive_description(update: Update, context: ContextTypes.DEF
         return ADDMEAL_ASK_DESCRIPTION
     context.user_data['addmeal_description'] = description
 
-    # Create InlineKeyboard for meal type selection
-    keyboard = [
-        [
-            InlineKeyboardButton("ناهار 🍚", callback_data=CALLBACK_ADDMEAL_TYPE_NAHAR),
-            InlineKeyboardButton("شام 🌙", callback_data=CALLBACK_ADDMEAL_TYPE_SHAM),
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("۲\\. نوع غذا را انتخاب کنید:", reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN_V2)
+    await update.message.reply_text("۲\\. نوع غذا را انتخاب کنید:", reply_markup=ADDMEAL_TYPE_KEYBOARD, parse_mode=ParseMode.MARKDOWN_V2)
     return ADDMEAL_ASK_TYPE
 
 
@@ -269,7 +326,7 @@ async def add_meal_receive_type_callback(update: Update, context: ContextTypes.D
 
     # Extract meal type from callback data
     # e.g., "addmeal_type_ناهار" -> "ناهار"
-    meal_type = query.data.split(CALLBACK_ADDMEAL_TYPE_PREFIX)[1]
+    meal_type = query.data.partition(CALLBACK_ADDMEAL_TYPE_PREFIX)[2]
 
     if not meal_type:
         await query.edit_message_text("خطا در انتخاب نوع غذا. لطفا دوباره تلاش کنید.")
@@ -289,11 +346,14 @@ async def add_meal_receive_type_callback(update: Update, context: ContextTypes.D
 async def add_meal_receive_date(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     date_str = update.message.text.strip()
     try:
-        # Use jdatetime.datetime.strptime to handle potential time component then get date
-        j_date = jdatetime.datetime.strptime(date_str, '%Y/%m/%d').date()
+        match = ADDMEAL_DATE_PATTERN.match(date_str)
+        if not match:
+            raise ValueError(f"Invalid Shamsi date format: {date_str}")
+        # The constructor raises ValueError for out-of-range month/day
+        j_date = jdatetime.date(int(match[1]), int(match[2]), int(match[3]))
 
         # Basic validation: Check if date is in the past (using jdatetime)
-        if j_date < jdatetime.date.today():
+        if j_date < _jalali_today():
             await update.message.reply_text(
                 "تاریخ غذا نمی‌تواند در گذشته باشد\\. لطفا تاریخ شمسی معتبری وارد کنید \\(YYYY/MM/DD\\):",
                 parse_mode=ParseMode.MARKDOWN_V2)
@@ -315,7 +375,8 @@ async def add_meal_receive_date(update: Update, context: ContextTypes.DEFAULT_TY
 async def add_meal_receive_price(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     price_str = update.message.text.strip()
     try:
-        price = Decimal(price_str)
+        # Prices are whole tomans; accept thousands separators like 12,000
+        price = int(price_str.replace(',', ''))
         if price <= 0:
             raise ValueError("قیمت باید مثبت باشد.")
         context.user_data['addmeal_price'] = price
@@ -323,28 +384,27 @@ async def add_meal_receive_price(update: Update, context: ContextTypes.DEFAULT_T
             "۵\\. حداکثر قیمت مجاز فروش \\(به تومان\\) را وارد کنید \\(عدد\\)\\. اگر محدودیت ندارد، '0' یا 'skip' را وارد کنید:",
             parse_mode=ParseMode.MARKDOWN_V2)
         return ADDMEAL_ASK_PRICELIMIT
-    except (InvalidOperation, ValueError) as e:
+    except ValueError as e:
         await update.message.reply_text(f"قیمت نامعتبر: {escape_markdown_v2(str(e))}\\. لطفا فقط عدد مثبت وارد کنید:")
         return ADDMEAL_ASK_PRICE
 
 async def add_meal_receive_price_limit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     price_limit_str = update.message.text.strip().lower()
     price_limit = None
-    if price_limit_str not in ['0', 'skip', '']:
+    if price_limit_str.isdecimal(): # Fast path: plain digits (incl. '0') need no further validation
+        price_limit = int(price_limit_str) or None # 0 means no limit
+    elif price_limit_str not in ['skip', '']:
         try:
-            price_limit_decimal = Decimal(price_limit_str)
-            if price_limit_decimal < 0: # Allow 0 for no limit, but not negative
+            price_limit_value = int(price_limit_str.replace(',', ''))
+            if price_limit_value < 0: # Allow 0 for no limit, but not negative
                  raise ValueError("حداکثر قیمت نمی‌تواند منفی باشد.")
-            if price_limit_decimal == 0 :
+            if price_limit_value == 0 :
                 price_limit = None # Treat 0 as no limit explicit None
             else:
-                price_limit = price_limit_decimal
-        except (InvalidOperation, ValueError) as e:
+                price_limit = price_limit_value
+        except ValueError as e:
             await update.message.reply_text(f"حداکثر قیمت نامعتبر: {escape_markdown_v2(str(e))}\\. لطفا عدد مثبت، '0' یا 'skip' وارد کنید:")
             return ADDMEAL_ASK_PRICELIMIT
-    elif price_limit_str == '0': # Explicitly handle '0' string as no limit
-        price_limit = None
-
 
     context.user_data['addmeal_price_limit'] = price_limit
 
@@ -357,7 +417,7 @@ async def add_meal_receive_price_limit(update: Update, context: ContextTypes.DEF
     mplimit_val = context.user_data['addmeal_price_limit']
 
     mplimit_display = "ندارد"
-    if isinstance(mplimit_val, Decimal):
+    if mplimit_val is not None:
         mplimit_display = f"`{mplimit_val:,.0f} تومان`"
 
     text = (
@@ -369,13 +429,7 @@ async def add_meal_receive_price_limit(update: Update, context: ContextTypes.DEF
         f"حداکثر قیمت فروش: {mplimit_display}\n"
         f"\nآیا این غذا به سیستم اضافه شود؟"
     )
-    keyboard = [
-        [
-            InlineKeyboardButton("✅ بله، اضافه کن", callback_data=CALLBACK_ADMIN_MEAL_CONFIRM_YES),
-            InlineKeyboardButton("❌ خیر، لغو کن", callback_data=CALLBACK_ADMIN_MEAL_CONFIRM_NO),
-        ]
-    ]
-    await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN_V2)
+    await update.message.reply_text(text, reply_markup=ADDMEAL_CONFIRM_KEYBOARD, parse_mode=ParseMode.MARKDOWN_V2)
     return ADDMEAL_CONFIRM
 
 async def add_meal_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -384,7 +438,7 @@ async def add_meal_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
     if query.data == CALLBACK_ADMIN_MEAL_CONFIRM_NO:
         await query.edit_message_text("عملیات افزودن غذا لغو شد.")
-        context.user_data.clear()
+        _clear_addmeal_user_data(context)
         return ConversationHandler.END
 
     description = context.user_data.get('addmeal_description')
@@ -395,27 +449,38 @@ async def add_meal_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
     if not all([description, meal_type, meal_date, price is not None]):
         await query.edit_message_text("خطا: اطلاعات ناقص است\\. لطفا دوباره با /addmeal شروع کنید\\.")
-        context.user_data.clear()
+        _clear_addmeal_user_data(context)
         return ConversationHandler.END
 
-    async with get_db_session() as db_session:
-        new_meal = await crud.create_meal(
-            db_session,
-            description=description,
-            meal_type=meal_type,
-            meal_date=meal_date,
-            price=price,
-            price_limit=price_limit
-        )
+    meal_data = {
+        'description': description,
+        'meal_type': meal_type,
+        'meal_date': meal_date,
+        'price': price,
+        'price_limit': price_limit,
+    }
+
+    # Acknowledge right away and insert in the background, so the handler doesn't wait on the DB
+    await query.edit_message_text("⏳ در حال افزودن غذا...")
+    context.application.create_task(_create_meal_and_report(query, meal_data), update=update)
+
+    _clear_addmeal_user_data(context)
+    return ConversationHandler.END
+
+async def _create_meal_and_report(query: CallbackQuery, meal_data: dict) -> None:
+    """Background task for add_meal_confirm: inserts the meal and edits the admin's message with the result."""
+    new_meal = None
+    try:
+        async with get_db_session() as db_session:
+            new_meal = await crud.create_meal(db_session, **meal_data)
+    except Exception as e:
+        logger.error(f"DB error creating meal '{meal_data.get('description')}': {e}", exc_info=True)
 
     if new_meal:
         await query.edit_message_text(f"✅ غذای '{escape_markdown_v2(new_meal.description)}' با موفقیت به سیستم اضافه شد \\(ID: `{new_meal.id}`\\)\\.", parse_mode=ParseMode.MARKDOWN_V2) # Escaped parentheses
     else:
         await query.edit_message_text("❌ خطا در افزودن غذا به پایگاه داده \\(ممکن است تکراری باشد یا خطای دیگری رخ داده باشد\\)\\.", parse_mode=ParseMode.MARKDOWN_V2) # Escaped parentheses
 
-    context.user_data.clear()
-    return ConversationHandler.END
-
 async def add_meal_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.callback_query:
         await update.callback_query.answer()
@@ -423,7 +488,14 @@ async def add_meal_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     elif update.message:
         await update.message.reply_text("عملیات افزودن غذا لغو شد.")
     logger.info(f"Admin {update.effective_user.id} cancelled add_meal conversation.")
-    context.user_data.clear()
+    _clear_addmeal_user_data(context)
+    return ConversationHandler.END
+
+async def add_meal_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Drops the partial /addmeal data when the conversation times out, so it isn't kept in persistence."""
+    _clear_addmeal_user_data(context)
+    user_id = update.effective_user.id if isinstance(update, Update) and update.effective_user else 'Unknown User'
+    logger.info(f"add_meal conversation timed out for admin {user_id}, partial data discarded.")
     return ConversationHandler.END
 
 
@@ -441,19 +513,22 @@ async def delete_meal_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
 
     async with get_db_session() as db_session:
-        meal_to_delete = await crud.get_meal_by_id(db_session, meal_id)
-        if not meal_to_delete:
-            await message.reply_text(f"غذا با آیدی {meal_id} یافت نشد\\.", parse_mode=ParseMode.MARKDOWN_V2)
-            return
-
-        deleted = await crud.delete_meal(db_session, meal_id)
+        deleted_description = await crud.delete_meal(db_session, meal_id)
 
-    if deleted:
-        await message.reply_text(f"✅ غذای '{escape_markdown_v2(meal_to_delete.description)}' \\(ID: `{meal_id}`\\) با موفقیت حذف شد\\.", parse_mode=ParseMode.MARKDOWN_V2) # Escaped parentheses
+    if deleted_description is not None:
+        await message.reply_text(f"✅ غذای '{escape_markdown_v2(deleted_description)}' \\(ID: `{meal_id}`\\) با موفقیت حذف شد\\.", parse_mode=ParseMode.MARKDOWN_V2) # Escaped parentheses
     else:
         await message.reply_text(f"❌ خطا در حذف غذا با آیدی {meal_id}\\. \\(ممکن است توسط آگهی‌ها استفاده شده باشد یا وجود نداشته باشد\\)", parse_mode=ParseMode.MARKDOWN_V2) # Escaped parentheses
 
 
+@admin_required
+async def db_pool_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # /dbpool
+    message = update.message
+    if not message: return
+    await message.reply_text(f"وضعیت استخر اتصال پایگاه داده:\n`{escape_markdown_v2(get_pool_status())}`", parse_mode=ParseMode.MARKDOWN_V2)
+
+
 # Listing Management Handlers
 @admin_required
 async def delete_listing_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -482,11 +557,12 @@ add_meal_conv_handler = ConversationHandler(
     entry_points=[CommandHandler("addmeal", add_meal_start)],
     states={
         ADDMEAL_ASK_DESCRIPTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_meal_receive_description)],
-        ADDMEAL_ASK_TYPE: [CallbackQueryHandler(add_meal_receive_type_callback, pattern=f"^{CALLBACK_ADDMEAL_TYPE_PREFIX}(ناهار|شام)$")],
+        ADDMEAL_ASK_TYPE: [CallbackQueryHandler(add_meal_receive_type_callback, pattern=ADDMEAL_TYPE_PATTERN)],
         ADDMEAL_ASK_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_meal_receive_date)],
         ADDMEAL_ASK_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_meal_receive_price)],
         ADDMEAL_ASK_PRICELIMIT: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_meal_receive_price_limit)],
-        ADDMEAL_CONFIRM: [CallbackQueryHandler(add_meal_confirm, pattern=f"^({CALLBACK_ADMIN_MEAL_CONFIRM_YES}|{CALLBACK_ADMIN_MEAL_CONFIRM_NO})$")],
+        ADDMEAL_CONFIRM: [CallbackQueryHandler(add_meal_confirm, pattern=ADDMEAL_CONFIRM_PATTERN)],
+        ConversationHandler.TIMEOUT: [TypeHandler(Update, add_meal_timeout)],
     },
     fallbacks=[
         CommandHandler("cancel", add_meal_cancel),
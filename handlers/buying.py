@@ -1,15 +1,17 @@
-import io
+import asyncio
 import logging
+import re
+import time
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
-from telegram.error import Forbidden, BadRequest
+from telegram.error import Forbidden, BadRequest, TelegramError
 from telegram.ext import ContextTypes
-from telegram.helpers import escape_markdown
 
+from config import BUY_LIST_MAX_LISTINGS
 from . import PERSIAN_DAYS_MAP
 from .common import (
     CALLBACK_BUY_REFRESH, CALLBACK_BUYER_CANCEL_PENDING,
-    CALLBACK_SELLER_REJECT_PENDING, get_main_menu_keyboard
+    CALLBACK_SELLER_REJECT_PENDING, get_main_menu_keyboard, RenderedMessageCache, match_callback
 )
 import utility
 from self_market.db.session import get_db_session
@@ -18,110 +20,189 @@ from self_market import models
 
 logger = logging.getLogger(__name__)
 
+# Callback data patterns; shared with the CallbackQueryHandler registrations in bot.py.
+# Group 1 is the listing ID.
+BUY_LISTING_PATTERN = re.compile(r'^buy_listing_(\d+)$')
+CONFIRM_BUY_PATTERN = re.compile(r'^confirm_buy_(\d+)$')
+BUYER_CANCEL_PENDING_PATTERN = re.compile(fr'^{CALLBACK_BUYER_CANCEL_PENDING}_(\d+)$')
+SELLER_REJECT_PENDING_PATTERN = re.compile(fr'^{CALLBACK_SELLER_REJECT_PENDING}_(\d+)$')
+SELLER_CONFIRM_PATTERN = re.compile(r'^seller_confirm_(\d+)$')
 
-# Helper function moved here as it's only used by buying handlers
-async def _generate_buy_food_response(db_session: crud.AsyncSession) -> tuple[str, InlineKeyboardMarkup | None]:
-    """
-    Fetches available listings and generates the message text and inline keyboard.
-    Includes the "Refresh" button.
 
-    Returns:
-        tuple[str, InlineKeyboardMarkup | None]: The message text and the keyboard markup.
-                                               Returns None for markup if no listings.
+async def _await_callback_answer(ack_task: asyncio.Task) -> None:
+    """
+    Waits for a callback answer started with asyncio.create_task before the handler's DB work.
+    A failed answer (e.g. a query too old to answer) is only logged: the DB change has been made
+    by then, so the handler must still go on to edit the message and notify the other party.
     """
-    available_listings = await crud.get_available_listings(db_session) # Should load seller+meal
+    try:
+        await ack_task
+    except TelegramError as e:
+        logger.warning("Failed to answer callback query: %s", e)
 
-    title = utility.escape_markdown_v2("🛒 لیست غذاهای موجود برای خرید:\n\n")
-    refresh_button = InlineKeyboardButton("🔄 بروزرسانی لیست", callback_data=CALLBACK_BUY_REFRESH)
 
-    if not available_listings:
-        message_text = title + utility.escape_markdown_v2("در حال حاضر هیچ غذایی برای فروش ثبت نشده است.")
-        # Still include Refresh button even if no listings
-        reply_markup = InlineKeyboardMarkup([[refresh_button]])
-        return message_text, reply_markup
+# The buy list is the same for every user, so the rendered response is shared for a few seconds.
+# It is rebuilt sooner whenever a listing change is committed (see crud.get_listings_version).
+BUY_LIST_CACHE_TTL_SECONDS = 3
+_buy_list_cache: tuple[float, int, str, InlineKeyboardMarkup | None] | None = None # (built_at, listings_version, text, markup)
+_buy_list_cache_lock = asyncio.Lock()
 
-    response_parts = [title]
-    inline_buttons = [] # List to hold button rows
+# Hash of the buy list last shown in each (chat_id, message_id), so no-op refreshes skip the Bot API call
+BUY_LIST_SENT_CACHE_SIZE = 4096
+_buy_list_last_sent = RenderedMessageCache(BUY_LIST_SENT_CACHE_SIZE)
 
-    for listing in available_listings:
-        meal_desc_raw = "غذای نامشخص"
-        shamsi_date_str_raw = "تاریخ نامشخص"
-        persian_day_name_raw = "روز نامشخص"
-        meal_type_raw = "نوع نامشخص"
 
-        if listing.meal:
-            meal = listing.meal
-            meal_desc_raw = meal.description or meal_desc_raw
-            meal_type_raw = meal.meal_type or meal_type_raw
-            if meal.date:
-                meal_date_obj = meal.date
-                shamsi_date_str_raw = utility.format_gregorian_date_to_shamsi(meal_date_obj)
-                day_of_week_int = meal_date_obj.weekday()
-                persian_day_name_raw = PERSIAN_DAYS_MAP.get(day_of_week_int, "روز نامشخص")
+# Rendered (text, button) per listing id, reused while the listing's displayed fields are unchanged
+_listing_render_cache: dict[int, tuple[tuple, str, InlineKeyboardButton]] = {}
+BUY_LIST_TITLE = utility.escape_markdown_v2("🛒 لیست غذاهای موجود برای خرید:\n\n")
+BUY_LIST_REFRESH_BUTTON = InlineKeyboardButton("🔄 بروزرسانی لیست", callback_data=CALLBACK_BUY_REFRESH)
+BUY_LIST_EMPTY_TEXT = BUY_LIST_TITLE + utility.escape_markdown_v2("در حال حاضر هیچ غذایی برای فروش ثبت نشده است.")
+# Still include Refresh button even if no listings
+BUY_LIST_EMPTY_MARKUP = InlineKeyboardMarkup([[BUY_LIST_REFRESH_BUTTON]])
+BUY_LIST_SEPARATOR = utility.escape_markdown_v2("--------------------") + "\n"
+BUY_LIST_MORE_NOTE = utility.escape_markdown_v2("...\n(فقط جدیدترین آگهی‌ها نمایش داده شده‌اند)")
+# Static half of the purchase confirmation row; only the confirm button carries the listing id
+PURCHASE_CANCEL_BUTTON = InlineKeyboardButton("❌ لغو", callback_data='cancel_buy')
 
-        # Escape user-generated content
-        meal_desc = utility.escape_markdown_v2(meal_desc_raw)
-        meal_type = utility.escape_markdown_v2(meal_type_raw)
-        shamsi_date_str = utility.escape_markdown_v2(shamsi_date_str_raw)
-        persian_day_name = utility.escape_markdown_v2(persian_day_name_raw)
-
-        # Escape seller name for Markdown V2 compatibility if needed, or use regular Markdown
-        seller_name_raw_display = "ناشناس"
-        if listing.seller and listing.seller.first_name:
-            seller_name_raw_display = listing.seller.first_name
-
-        # Prepare the display part of the link, escaping it
-        escaped_seller_display_name = utility.escape_markdown_v2(seller_name_raw_display)
-
-        seller_name_md = utility.escape_markdown_v2("ناشناس")  # Default if no seller info
-        if listing.seller:
-            seller_telegram_id = listing.seller.telegram_id
-            if listing.seller.username:
-                username_display_text = f"@{listing.seller.username}"
-                escaped_link_text = utility.escape_markdown_v2(username_display_text)
-                seller_name_md = f"[{escaped_link_text}](https://t.me/{listing.seller.username})"
-            else:
-                first_name_raw = listing.seller.first_name if listing.seller.first_name else "ناشناس"
-                link_text_raw = f"{first_name_raw} (ID: {seller_telegram_id})"  # Keep (ID: ...) unescaped inside link text for now
-                escaped_link_text = utility.escape_markdown_v2(link_text_raw)
-                seller_name_md = f"[{escaped_link_text}](tg://user?id={seller_telegram_id})"
 
+def _get_cached_buy_food_response() -> tuple[str, InlineKeyboardMarkup | None] | None:
+    if _buy_list_cache is None:
+        return None
+    built_at, listings_version, message_text, reply_markup = _buy_list_cache
+    if time.monotonic() - built_at >= BUY_LIST_CACHE_TTL_SECONDS or listings_version != crud.get_listings_version():
+        return None
+    return message_text, reply_markup
 
-        price_str_raw = f"{listing.price:,.0f}" if listing.price is not None else "نامشخص"
-        price_str = utility.escape_markdown_v2(price_str_raw)
 
-        part = (
-            f"🍽️ *{meal_desc}* \\({meal_type} \\- {persian_day_name}، {shamsi_date_str}\\)\n"
-            f"👤 فروشنده: {seller_name_md}\n"
-            f"💰 قیمت: {price_str} تومان\n"
-            f"🆔 شماره آگهی: `{listing.id}`\n"
-        )
-        response_parts.append(part)
+# Helper function moved here as it's only used by buying handlers
+async def _generate_buy_food_response(db_session: crud.AsyncSession) -> tuple[str, InlineKeyboardMarkup | None]:
+    """
+    Returns the buy list message text and inline keyboard, from the short-lived shared cache
+    when it is still valid. Concurrent callers wait for a single rebuild.
+    """
+    global _buy_list_cache
+    cached = _get_cached_buy_food_response()
+    if cached:
+        return cached
+
+    async with _buy_list_cache_lock:
+        cached = _get_cached_buy_food_response() # Another caller may have rebuilt it meanwhile
+        if cached:
+            return cached
+        listings_version = crud.get_listings_version() # Read before querying, so a concurrent change invalidates this build
+        message_text, reply_markup = await _build_buy_food_response(db_session)
+        _buy_list_cache = (time.monotonic(), listings_version, message_text, reply_markup)
+        return message_text, reply_markup
 
-        inline_buttons.append([
-            InlineKeyboardButton(
-                f"خرید آگهی {listing.id} ({price_str_raw} تومان)",
-                callback_data=f'buy_listing_{listing.id}'
-            )
-        ])
-        # Add a separator after each listing's details
-        response_parts.append(utility.escape_markdown_v2("--------------------") + "\n")
 
-    # Add the refresh button as the last row
-    inline_buttons.append([refresh_button])
-    full_message = "".join(response_parts)
-    reply_markup = InlineKeyboardMarkup(inline_buttons)
+def _render_buy_listing(listing: models.Listing) -> tuple[str, InlineKeyboardButton]:
+    """Renders one listing of the buy list: its MarkdownV2 text block and its buy button."""
+    meal_desc_raw = "غذای نامشخص"
+    shamsi_date_str_raw = "تاریخ نامشخص"
+    persian_day_name_raw = "روز نامشخص"
+    meal_type_raw = "نوع نامشخص"
+
+    if listing.meal:
+        meal = listing.meal
+        meal_desc_raw = meal.description or meal_desc_raw
+        meal_type_raw = meal.meal_type or meal_type_raw
+        if meal.date:
+            meal_date_obj = meal.date
+            shamsi_date_str_raw = utility.format_gregorian_date_to_shamsi(meal_date_obj)
+            day_of_week_int = meal_date_obj.weekday()
+            persian_day_name_raw = PERSIAN_DAYS_MAP.get(day_of_week_int, "روز نامشخص")
+
+    # Escape user-generated content
+    meal_desc = utility.escape_markdown_v2(meal_desc_raw)
+    meal_type = utility.escape_markdown_v2(meal_type_raw)
+    shamsi_date_str = utility.escape_markdown_v2(shamsi_date_str_raw)
+    persian_day_name = utility.escape_markdown_v2(persian_day_name_raw)
+
+    seller_name_md = utility.escape_markdown_v2("ناشناس")  # Default if no seller info
+    if listing.seller:
+        seller = listing.seller
+        seller_name_md = utility.render_seller_link_md(seller.telegram_id, seller.username, seller.first_name)
+
+
+    price_str_raw = f"{listing.price:,.0f}" if listing.price is not None else "نامشخص"
+    price_str = utility.escape_markdown_v2(price_str_raw)
+
+    part = (
+        f"🍽️ *{meal_desc}* \\({meal_type} \\- {persian_day_name}، {shamsi_date_str}\\)\n"
+        f"👤 فروشنده: {seller_name_md}\n"
+        f"💰 قیمت: {price_str} تومان\n"
+        f"🆔 شماره آگهی: `{listing.id}`\n"
+    )
+    button = InlineKeyboardButton(
+        f"خرید آگهی {listing.id} ({price_str_raw} تومان)",
+        callback_data=f'buy_listing_{listing.id}'
+    )
+    return part, button
+
+
+def _get_rendered_buy_listing(listing: models.Listing) -> tuple[str, InlineKeyboardButton]:
+    """Returns the rendered listing from the fragment cache, re-rendering only if a displayed field changed."""
+    seller, meal = listing.seller, listing.meal
+    render_key = (
+        listing.updated_at, listing.price,
+        seller.telegram_id if seller else None, seller.username if seller else None, seller.first_name if seller else None,
+        meal.description if meal else None, meal.meal_type if meal else None, meal.date if meal else None,
+    )
+    cached = _listing_render_cache.get(listing.id)
+    if cached and cached[0] == render_key:
+        return cached[1], cached[2]
+    part, button = _render_buy_listing(listing)
+    _listing_render_cache[listing.id] = (render_key, part, button)
+    return part, button
+
+
+async def _build_buy_food_response(db_session: crud.AsyncSession) -> tuple[str, InlineKeyboardMarkup | None]:
+    """
+    Fetches available listings and generates the message text and inline keyboard.
+    Includes the "Refresh" button.
 
-    # Handle potential length issues (optional refinement)
-    if len(full_message) > 4096:
-        logger.warning("Generated buy food list message exceeds 4096 chars, might be truncated by Telegram.")
-        # Smart truncation
-        truncated_message = full_message[:4000]  # Leave some space for ellipsis and note
-        # Find last complete line
-        last_newline = truncated_message.rfind('\n')
-        if last_newline != -1:
-            truncated_message = truncated_message[:last_newline]
-        full_message = truncated_message + "\n" + utility.escape_markdown_v2("...\n(لیست برای نمایش خلاصه شد)")
+    Returns:
+        tuple[str, InlineKeyboardMarkup | None]: The message text and the keyboard markup.
+                                               Returns None for markup if no listings.
+    """
+    # Fetch one extra row only to know whether more listings exist than are shown
+    available_listings = await crud.get_available_listings(db_session, limit=BUY_LIST_MAX_LISTINGS + 1) # Should load seller+meal
+    has_more = len(available_listings) > BUY_LIST_MAX_LISTINGS
+    available_listings = available_listings[:BUY_LIST_MAX_LISTINGS]
+
+    # With the BUY_LIST_MAX_LISTINGS cap the render is short, so it runs inline
+    return _render_buy_food_response(available_listings, has_more)
+
+
+def _render_buy_food_response(available_listings: list[models.Listing], has_more: bool) -> tuple[str, InlineKeyboardMarkup | None]:
+    """Renders the buy list from already-loaded listings. Pure CPU work, no DB or network access."""
+    if not available_listings:
+        _listing_render_cache.clear()
+        return BUY_LIST_EMPTY_TEXT, BUY_LIST_EMPTY_MARKUP
+
+    parts, buttons = zip(*[_get_rendered_buy_listing(listing) for listing in available_listings])
+
+    # Drop fragments of listings that are no longer available
+    if len(_listing_render_cache) > len(available_listings):
+        live_ids = {listing.id for listing in available_listings}
+        for listing_id in [lid for lid in _listing_render_cache if lid not in live_ids]:
+            del _listing_render_cache[listing_id]
+
+    # Unusually long descriptions could still overflow Telegram's 4096-char limit;
+    # drop whole listings from the end so the MarkdownV2 stays well-formed
+    rendered_len = len(BUY_LIST_TITLE) + sum(map(len, parts)) + len(parts) * len(BUY_LIST_SEPARATOR) + len(BUY_LIST_MORE_NOTE)
+    while rendered_len > 4096 and len(parts) > 1:
+        rendered_len -= len(parts[-1]) + len(BUY_LIST_SEPARATOR)
+        parts, buttons = parts[:-1], buttons[:-1]
+        has_more = True
+
+    # Each listing's details are followed by a separator; one button row per listing, refresh button last
+    full_message = BUY_LIST_TITLE + BUY_LIST_SEPARATOR.join(parts) + BUY_LIST_SEPARATOR
+    if has_more:
+        full_message += BUY_LIST_MORE_NOTE
+    inline_buttons = [[button] for button in buttons]
+    inline_buttons.append([BUY_LIST_REFRESH_BUTTON])
+    reply_markup = InlineKeyboardMarkup(inline_buttons)
 
     return full_message, reply_markup
 
@@ -135,9 +216,9 @@ async def handle_buy_food(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if not user or not message:
         return
 
-    logger.info(f"'Buy Food' button pressed by user {user.id}")
+    logger.info("'Buy Food' button pressed by user %s", user.id)
 
-    # Check Verification Status
+    # Check verification status and build the list in one session; reply after it is released
     try:
         async with get_db_session() as db_session:
             db_user = await crud.get_or_create_user_and_update_info(db_session, user)
@@ -146,28 +227,34 @@ async def handle_buy_food(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             #      logger.error(f"User {user.id} not found in DB during buy food.")
             #      await message.reply_text("خطا: اطلاعات کاربری شما یافت نشد. لطفا /start بزنید.")
             #      return
-            if not db_user.is_verified:
-                logger.warning(f"Unverified user {user.id} attempted action: buy food")
-                await message.reply_text("برای خرید غذا، ابتدا باید فرآیند اعتبارسنجی را با دستور /start کامل کنید.")
-                return
+            is_verified = db_user.is_verified
+            if is_verified:
+                message_text, reply_markup = await _generate_buy_food_response(db_session)
     except Exception as e:
-        logger.error(f"DB error checking user verification for {user.id} in handle_buy_food: {e}", exc_info=True)
-        await message.reply_text("خطا در بررسی وضعیت اعتبارسنجی. لطفا دوباره تلاش کنید.")
+        logger.error("DB error checking verification or loading listings for %s in handle_buy_food: %s", user.id, e, exc_info=True)
+        await message.reply_text("خطا در دریافت لیست غذاها. لطفا دوباره تلاش کنید.")
         return
 
-    try:
-        message_text, reply_markup = await _generate_buy_food_response(db_session)
+    if not is_verified:
+        logger.warning("Unverified user %s attempted action: buy food", user.id)
+        await message.reply_text("برای خرید غذا، ابتدا باید فرآیند اعتبارسنجی را با دستور /start کامل کنید.")
+        return
 
+    try:
         # Send the response
-        await message.reply_text(
+        sent_message = await message.reply_text(
             message_text,
             parse_mode=ParseMode.MARKDOWN_V2,
             reply_markup=reply_markup,
             disable_web_page_preview=True  # Good practice for lists
         )
+        _buy_list_last_sent.remember(
+            sent_message.chat_id, sent_message.message_id,
+            RenderedMessageCache.render_hash(message_text, reply_markup)
+        )
 
     except Exception as e:
-        logger.error(f"Failed to get or format available listings for user {user.id}: {e}", exc_info=True)
+        logger.error("Failed to send available listings to user %s: %s", user.id, e, exc_info=True)
         await message.reply_text(
             "خطا در دریافت لیست غذاها. لطفا دوباره تلاش کنید."
         )
@@ -181,19 +268,26 @@ async def handle_buy_refresh(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     # await query.answer("🔄 در حال بروزرسانی...") # Acknowledge button press
 
-    logger.info(f"User {user.id} pressed 'Refresh List' for buy food.")
+    logger.info("User %s pressed 'Refresh List' for buy food.", user.id)
 
     message_text = "خطا در بروزرسانی لیست."  # Default error
     reply_markup = None  # Default markup
 
     try:
         async with get_db_session() as db_session:  # Session acquired
-            # Acknowledge button press *after* getting session, before long operation
-            # This is generally safer than acknowledging right at the start.
-            # If DB connection fails, the user doesn't get a potentially misleading "updating" message.
-            await query.answer("🔄 در حال بروزرسانی...")
             message_text, reply_markup = await _generate_buy_food_response(db_session)
 
+        # Acknowledge button press *after* building the list, so the answer can say whether it changed.
+        # If DB connection fails, the user doesn't get a potentially misleading "updating" message.
+        list_hash = RenderedMessageCache.render_hash(message_text, reply_markup)
+        sent_key = (query.message.chat_id, query.message.message_id) if query.message else None
+        if sent_key and _buy_list_last_sent.is_shown(*sent_key, list_hash):
+            # The message already shows this exact list; skip the edit round-trip
+            logger.info("Buy list refresh for user %s resulted in no changes.", user.id)
+            await query.answer("لیست بروز است.")
+            return
+        await query.answer("🔄 در حال بروزرسانی...")
+
         # Edit the message *after* the session is closed
         try:
             await query.edit_message_text(
@@ -202,35 +296,38 @@ async def handle_buy_refresh(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 reply_markup=reply_markup,
                 disable_web_page_preview=True
             )
-            logger.debug(f"Successfully refreshed buy list for user {user.id}")
+            if sent_key:
+                _buy_list_last_sent.remember(*sent_key, list_hash)
+            logger.debug("Successfully refreshed buy list for user %s", user.id)
         except BadRequest as e:
             # Explicitly check for "Message is not modified"
             if "Message is not modified" in str(e):
-                logger.info(f"Buy list refresh for user {user.id} resulted in no changes.")
-                # Answer the callback quietly if the message didn't change
-                await query.answer("لیست بروز است.")
+                # Message wasn't in the sent-list cache (e.g. after a restart) but was already up to date
+                logger.info("Buy list refresh for user %s resulted in no changes.", user.id)
+                if sent_key:
+                    _buy_list_last_sent.remember(*sent_key, list_hash)
             else:
                 # Log and report other BadRequest errors
-                logger.error(f"Unhandled BadRequest refreshing buy list for user {user.id}: {e}", exc_info=True)
+                logger.error("Unhandled BadRequest refreshing buy list for user %s: %s", user.id, e, exc_info=True)
                 # Use answer for non-critical errors after initial edit attempt
                 await query.answer("خطای تلگرام در بروزرسانی.", show_alert=True)
         except Forbidden:
-            logger.warning(f"Bot blocked by user {user.id}, cannot refresh buy list.")
+            logger.warning("Bot blocked by user %s, cannot refresh buy list.", user.id)
             await query.answer("خطا: امکان ویرایش پیام نیست. ربات مسدود شده؟", show_alert=True)
         except Exception as e_edit:
             # Catch other potential errors during edit_message_text
-            logger.error(f"Error editing message after refresh for user {user.id}: {e_edit}", exc_info=True)
+            logger.error("Error editing message after refresh for user %s: %s", user.id, e_edit, exc_info=True)
             await query.answer("خطا در نمایش لیست بروز شده.", show_alert=True)
 
     except Exception as e_db:
         # This catches errors during DB interaction (within async with)
-        logger.error(f"Error fetching data for buy list refresh for user {user.id}: {e_db}", exc_info=True)
+        logger.error("Error fetching data for buy list refresh for user %s: %s", user.id, e_db, exc_info=True)
         # If DB fails, we might not have even answered the callback yet
         try:
             # Try to answer the original callback with an error
             await query.answer("خطا در دریافت اطلاعات بروز شده.", show_alert=True)
         except Exception as e_answer:
-            logger.error(f"Failed to even answer callback query after DB error: {e_answer}")
+            logger.error("Failed to even answer callback query after DB error: %s", e_answer)
         # Also try to edit the message if possible (might fail if query already answered)
         try:
             await query.edit_message_text("خطا در دریافت اطلاعات بروز شده.")
@@ -245,40 +342,51 @@ async def handle_purchase_button(update: Update, context: ContextTypes.DEFAULT_T
     await query.answer()
 
     callback_data = query.data
-    try:
-        listing_id = int(callback_data.split('_')[-1]) # Extracts ID from 'buy_listing_ID'
-        logger.info(f"User {user.id} initiated purchase for listing {listing_id}")
-    except (ValueError, IndexError):
-        logger.error(f"Invalid callback data format for buy button: {callback_data}")
+    match = match_callback(context, BUY_LISTING_PATTERN, callback_data)
+    if not match:
+        logger.error("Invalid callback data format for buy button: %s", callback_data)
         await query.edit_message_text("خطای داخلی: دکمه نامعتبر.")
         return
+    listing_id = int(match[1]) # Extracts ID from 'buy_listing_ID'
+    logger.info("User %s initiated purchase for listing %s", user.id, listing_id)
+
+    # Verification is never revoked, so once seen it is remembered in user_data and the user lookup is skipped
+    buyer_db_id = context.user_data.get('buyer_db_id') if context.user_data.get('is_verified') else None
+    is_verified = buyer_db_id is not None
 
-    # Check user verification status
+    # Check user verification status and fetch listing details in one session; reply after it is released
+    listing = None
     try:
         async with get_db_session() as db_session:
-             buyer_db_user = await crud.get_user_by_telegram_id(db_session, user.id)
-             if not buyer_db_user or not buyer_db_user.is_verified:
-                 logger.warning(f"Unverified user {user.id} clicked buy button for listing {listing_id}.")
-                 await query.answer("برای خرید باید ابتدا اعتبارسنجی شوید (/start).", show_alert=True)
-                 return
+            if not is_verified:
+                buyer_db_user = await crud.get_user_by_telegram_id(db_session, user.id)
+                is_verified = bool(buyer_db_user and buyer_db_user.is_verified)
+                if is_verified:
+                    buyer_db_id = buyer_db_user.id
+                    context.user_data['is_verified'] = True
+                    context.user_data['buyer_db_id'] = buyer_db_id
+            if is_verified:
+                # get_listing_by_id should load seller and meal
+                listing = await crud.get_listing_by_id(db_session, listing_id)
     except Exception as e:
-        logger.error(f"DB Error checking buyer {user.id} verification: {e}")
+        logger.error("DB Error checking buyer %s verification or fetching listing %s: %s", user.id, listing_id, e)
         await query.edit_message_text("خطا در بررسی اعتبارسنجی.")
         return
 
-    # Fetch listing details for confirmation
-    try:
-        async with get_db_session() as db_session:
-            # get_listing_by_id should load seller and meal
-            listing = await crud.get_listing_by_id(db_session, listing_id)
+    if not is_verified:
+        logger.warning("Unverified user %s clicked buy button for listing %s.", user.id, listing_id)
+        await query.answer("برای خرید باید ابتدا اعتبارسنجی شوید (/start).", show_alert=True)
+        return
 
+    # Show listing details for confirmation
+    try:
         if not listing:
             await query.edit_message_text("متاسفانه این آگهی دیگر موجود نیست.")
             return
         if listing.status != models.ListingStatus.AVAILABLE:
              await query.edit_message_text(f"این آگهی در حال حاضر برای خرید در دسترس نیست (وضعیت: {listing.status.value}).")
              return
-        if listing.seller_id == user.id: # Check against DB user ID
+        if listing.seller_id == buyer_db_id: # Check against DB user ID
              await query.edit_message_text("شما نمی‌توانید آگهی خودتان را بخرید.")
              return
 
@@ -298,40 +406,17 @@ async def handle_purchase_button(update: Update, context: ContextTypes.DEFAULT_T
                 except AttributeError:
                     meal_date_str_raw = str(meal.date)
 
-        # Escape all dynamic parts for MarkdownV2
-        meal_desc = escape_markdown(meal_desc_raw, version=2)
-        meal_type = escape_markdown(meal_type_raw, version=2)
-        meal_date_str = escape_markdown(meal_date_str_raw, version=2)
-
-        seller_telegram_id = listing.seller.telegram_id
-        seller_name = "ناشناس"
-
-        if listing.seller.username:
-            # Link text will be @username
-            # Link URL will be https://t.me/username
-            # The username part of the link text needs to be escaped for MarkdownV2
-            username_display_text = f"@{listing.seller.username}"
-            escaped_link_text = escape_markdown(username_display_text, version=2)
-            # The username in the URL itself does not need Markdown escaping
-            seller_name = f"[{escaped_link_text}](https://t.me/{listing.seller.username})"
-        else:
-            # 2. No username, use First Name (ID: TELEGRAM_ID)
-            # Link text will be "FirstName (ID: 1234567)"
-            # Link URL will be tg://user?id=1234567
-
-            # Fallback for first_name if it's None or empty
-            first_name_raw = listing.seller.first_name if listing.seller.first_name else "ناشناس"
-
-            # Construct the full display text for the link
-            link_text_raw = f"{first_name_raw} (ID: {seller_telegram_id})"
-            escaped_link_text = escape_markdown(link_text_raw, version=2)
-            seller_name = f"[{escaped_link_text}](tg://user?id={seller_telegram_id})"
-
+        # Escape all dynamic text parts for MarkdownV2 (compiled pattern, memoized per string)
+        meal_desc = utility.escape_markdown_v2(meal_desc_raw)
+        meal_type = utility.escape_markdown_v2(meal_type_raw)
+        meal_date_str = utility.escape_markdown_v2(meal_date_str_raw)
 
+        seller = listing.seller
+        seller_name = utility.render_seller_link_md(seller.telegram_id, seller.username, seller.first_name)
 
         price_raw = listing.price
-        price_str = escape_markdown(f"{price_raw:,.0f}" if price_raw is not None else "نامشخص", version=2)
-        listing_id_str = escape_markdown(str(listing.id), version=2)
+        price_str = utility.escape_markdown_v2(f"{price_raw:,.0f}" if price_raw is not None else "نامشخص")
+        listing_id_str = str(listing.id) # Digits only, nothing to escape
 
         # Use the corrected variables here
         confirmation_text = (
@@ -346,33 +431,57 @@ async def handle_purchase_button(update: Update, context: ContextTypes.DEFAULT_T
             # Escaped literal parentheses here:
             "_\\(با تایید، اطلاعات پرداخت فروشنده به شما نمایش داده می‌شود و آگهی برای دیگران غیرفعال خواهد شد تا فروشنده پرداخت شما را تایید کند\\.\\)_"
         )
-        confirm_buttons = [[
-            InlineKeyboardButton("✅ بله، خرید را تایید می‌کنم", callback_data=f'confirm_buy_{listing_id}'),
-            InlineKeyboardButton("❌ لغو", callback_data='cancel_buy')
-        ]]
-        reply_markup = InlineKeyboardMarkup(confirm_buttons)
+        confirm_button = InlineKeyboardButton("✅ بله، خرید را تایید می‌کنم", callback_data=f'confirm_buy_{listing_id}')
+        reply_markup = InlineKeyboardMarkup([[confirm_button, PURCHASE_CANCEL_BUTTON]])
         await query.edit_message_text(confirmation_text, parse_mode=ParseMode.MARKDOWN_V2, reply_markup=reply_markup)
 
     except Exception as e:
-        logger.error(f"Error preparing purchase confirmation for listing {listing_id}: {e}", exc_info=True)
+        logger.error("Error preparing purchase confirmation for listing %s: %s", listing_id, e, exc_info=True)
         await query.edit_message_text("خطا در نمایش اطلاعات خرید.")
 
 
 
+# Buyer's message after reserving a listing (MarkdownV2). The constant text is escaped once at import;
+# placeholders take already-escaped values. (None of the escaped constants contain '{' or '}'.)
+BUYER_PENDING_MESSAGE_TEMPLATE = (
+    utility.escape_markdown_v2("درخواست خرید شما برای آگهی ") + "`{listing_id}`"
+    + utility.escape_markdown_v2(" (") + "{meal_desc}" + utility.escape_markdown_v2(") ثبت شد.\n")
+    + utility.escape_markdown_v2("⏳ لطفا مبلغ ") + "*{price} تومان*"
+    + utility.escape_markdown_v2(" را به شماره کارت زیر واریز نمایید:\n\n")
+    + utility.escape_markdown_v2("💳 ") + "`{card_number}`" + "\n\n"
+    + utility.escape_markdown_v2("پس از واریز، فروشنده باید دریافت وجه را تایید کند.\n")
+    + utility.escape_markdown_v2("🚨 ")
+    + f"*{utility.escape_markdown_v2('هشدار:')}* {utility.escape_markdown_v2(' ربات مسئولیتی در قبال تراکنش ندارد.')}\n\n"
+    + utility.escape_markdown_v2("در صورت انصراف از خرید، دکمه زیر را بزنید:")
+)
+
+# Plain-text seller notice, used when the MarkdownV2 one is rejected
+SELLER_PENDING_FALLBACK_TEMPLATE = "درخواست خرید جدید برای آگهی {listing_id} از کاربر {buyer}. لطفا برای تایید یا رد به ربات مراجعه کنید."
+
+# User-facing messages for crud.set_listing_awaiting_confirmation failures
+PURCHASE_FAILURE_MESSAGES = {
+    crud.PurchaseFailureReason.LISTING_NOT_FOUND: "متاسفانه این آگهی یافت نشد.",
+    crud.PurchaseFailureReason.OWN_LISTING: "شما نمی‌توانید آگهی خودتان را بخرید.",
+    crud.PurchaseFailureReason.BUYER_NOT_FOUND: "خطا: اطلاعات کاربری شما یافت نشد. لطفا /start بزنید.",
+    crud.PurchaseFailureReason.DB_ERROR: "خطا در بروزرسانی وضعیت آگهی.",
+}
+
 async def handle_confirm_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles the 'Confirm Buy' button. Sets listing to AWAITING_CONFIRMATION, notifies users."""
     query = update.callback_query
     user = update.effective_user # This is the BUYER
-    await query.answer("در حال ثبت درخواست خرید...")
+    # The answer's round trip overlaps the DB work below
+    ack_task = asyncio.create_task(query.answer("در حال ثبت درخواست خرید..."))
 
     callback_data = query.data
-    try:
-        listing_id = int(callback_data.split('_')[-1]) # Extract ID from confirm_buy_ID
-        logger.info(f"User {user.id} confirmed purchase intent for listing {listing_id}")
-    except (ValueError, IndexError):
-        logger.error(f"Invalid confirm callback data format: {callback_data}")
+    match = match_callback(context, CONFIRM_BUY_PATTERN, callback_data)
+    if not match:
+        logger.error("Invalid confirm callback data format: %s", callback_data)
+        await _await_callback_answer(ack_task)
         await query.edit_message_text("خطای داخلی: دکمه نامعتبر.")
         return
+    listing_id = int(match[1]) # Extract ID from confirm_buy_ID
+    logger.info("User %s confirmed purchase intent for listing %s", user.id, listing_id)
 
     # --- Update Listing Status and Get Seller Info ---
     updated_listing: models.Listing | None = None
@@ -383,91 +492,48 @@ async def handle_confirm_purchase(update: Update, context: ContextTypes.DEFAULT_
     try:
         async with get_db_session() as db_session:
             # Set listing status and pending buyer
-            updated_listing = await crud.set_listing_awaiting_confirmation(
+            updated_listing, failure_reason = await crud.set_listing_awaiting_confirmation(
                 db=db_session,
                 listing_id=listing_id,
                 buyer_telegram_id=user.id
             )
 
-            # Check Failure Reason IF update failed
-            if not updated_listing:
-                # CRUD function returned None, meaning pre-check failed (logged in CRUD)
-                # Re-fetch listing to determine specific reason for user message
-                listing_check = await crud.get_listing_by_id(db_session, listing_id)  # Use same session
-
-                # Set specific user-facing error message based on re-check
-                if listing_check and listing_check.seller_id == user.id:
-                    error_message = "شما نمی‌توانید آگهی خودتان را بخرید."  # Specific message
-                elif listing_check and listing_check.status != models.ListingStatus.AVAILABLE:
-                    error_message = f"متاسفانه این آگهی دیگر برای خرید موجود نیست (وضعیت: {listing_check.status.value})."  # Specific message
-                elif not listing_check:
-                    error_message = "متاسفانه این آگهی یافت نشد."  # Specific message
-                else:
-                    # Default if reason isn't clear from re-check
-                    error_message = "خطا در بروزرسانی وضعیت آگهی."
+            # Pick the user-facing error message from the failure reason CRUD already determined
+            if failure_reason == crud.PurchaseFailureReason.NOT_AVAILABLE:
+                error_message = f"متاسفانه این آگهی دیگر برای خرید موجود نیست (وضعیت: {updated_listing.status.value})."
+                updated_listing = None
+            elif failure_reason:
+                error_message = PURCHASE_FAILURE_MESSAGES.get(failure_reason, "خطا در بروزرسانی وضعیت آگهی.")
+                updated_listing = None
 
             elif updated_listing:
                 if updated_listing.seller:
                     seller_card_number = updated_listing.seller.credit_card_number
                     seller_telegram_id = updated_listing.seller.telegram_id
                 else:
-                    logger.error(f"Listing {listing_id} seller info could not be loaded after update.")
+                    logger.error("Listing %s seller info could not be loaded after update.", listing_id)
                     error_message = "خطا: اطلاعات فروشنده یافت نشد."
                     updated_listing = None  # Mark as failed for subsequent logic
 
     except Exception as e:
-        logger.error(f"Error setting listing {listing_id} to awaiting confirmation: {e}", exc_info=True)
+        logger.error("Error setting listing %s to awaiting confirmation: %s", listing_id, e, exc_info=True)
         error_message = "خطای جدی در پردازش درخواست رخ داد."
         updated_listing = None
 
+    await _await_callback_answer(ack_task)
+
     # Notify Buyer and Seller
     if updated_listing and seller_card_number and seller_telegram_id:
         price_str = f"{updated_listing.price:,.0f}" if updated_listing.price is not None else "مبلغ"
         # Escape meal_desc for V2 *before* using it in the f-string for buyer
         raw_meal_description = updated_listing.meal.description if updated_listing.meal else "غذا"
 
-        # Construct parts and escape them as needed for MARKDOWN_V2
-        part1 = f"درخواست خرید شما برای آگهی "
-        part2_listing_id = f"`{listing_id}`"  # listing_id is an int, safe in backticks
-        part3_meal_intro = f" ("
-        # meal_desc_escaped should be the result of utility.escape_markdown_v2(raw_meal_description)
-        part4_meal_desc = utility.escape_markdown_v2(raw_meal_description)
-        part5_meal_outro_and_status = f") ثبت شد.\n"  # Note the period here
-
-        part6_payment_instruction1 = f"⏳ لطفا مبلغ "
-        # **{price_str} تومان** - bold is V2 syntax, price_str is numeric
-        part7_price = f"*{utility.escape_markdown_v2(price_str)} تومان*"  # Escape price_str just in case, then bold
-        part8_payment_instruction2 = f" را به شماره کارت زیر واریز نمایید:\n\n"
-
-        part9_card_intro = f"💳 "
-        # `{utility.escape_markdown_v2(seller_card_number)}` - card number in backticks, content escaped
-        part10_card_number = f"`{utility.escape_markdown_v2(seller_card_number)}`"
-        part11_card_outro = f"\n\n"
-
-        part12_seller_confirmation_notice = f"پس از واریز، فروشنده باید دریافت وجه را تایید کند.\n"  # Note the period
-        part13_warning_intro = f"🚨 "
-        part14_warning_text = f"*هشدار:* ربات مسئولیتی در قبال تراکنش ندارد.\n\n"  # Note the period, bold text
-        part15_cancellation_option = f"در صورت انصراف از خرید، دکمه زیر را بزنید:"
-
-        buyer_message = (
-            f"{utility.escape_markdown_v2(part1)}"
-            f"{part2_listing_id}"
-            f"{utility.escape_markdown_v2(part3_meal_intro)}"
-            f"{part4_meal_desc}"  # Assumed already escaped or use the raw and escape here
-            f"{utility.escape_markdown_v2(part5_meal_outro_and_status)}"
-            f"{utility.escape_markdown_v2(part6_payment_instruction1)}"
-            f"{part7_price}"  # price_str is now wrapped in utility.escape_markdown_v2 then bolded
-            f"{utility.escape_markdown_v2(part8_payment_instruction2)}"
-            f"{utility.escape_markdown_v2(part9_card_intro)}"
-            f"{part10_card_number}"  # seller_card_number is escaped and in backticks
-            f"{utility.escape_markdown_v2(part11_card_outro)}"
-            f"{utility.escape_markdown_v2(part12_seller_confirmation_notice)}"
-            f"{utility.escape_markdown_v2(part13_warning_intro)}"
-            # For part14_warning_text, since it contains *...*, we need to be careful.
-            # If we want "هشدار:" to be bold, we construct it as *{escaped_text}*
-            # The colon and the period also need escaping.
-            f"*{utility.escape_markdown_v2('هشدار:')}* {utility.escape_markdown_v2(' ربات مسئولیتی در قبال تراکنش ندارد.')}\n\n"
-            f"{utility.escape_markdown_v2(part15_cancellation_option)}"
+        # Only the dynamic fields are escaped per request; the constant text is pre-escaped in the template
+        buyer_message = BUYER_PENDING_MESSAGE_TEMPLATE.format(
+            listing_id=listing_id,  # listing_id is an int, safe in backticks
+            meal_desc=utility.escape_markdown_v2(raw_meal_description),
+            price=utility.escape_markdown_v2(price_str),
+            card_number=utility.escape_markdown_v2(seller_card_number),
         )
 
         buyer_cancel_button = InlineKeyboardButton(
@@ -476,102 +542,124 @@ async def handle_confirm_purchase(update: Update, context: ContextTypes.DEFAULT_
         )
         buyer_markup = InlineKeyboardMarkup([[buyer_cancel_button]])
 
-        # When sending this message, use ParseMode.MARKDOWN_V2
-        logger.debug(f"BUYER MESSAGE (handle_confirm_purchase) constructed: {buyer_message}")
-        await query.edit_message_text(
-            text=buyer_message,
-            parse_mode=ParseMode.MARKDOWN_V2,
-            reply_markup=buyer_markup
+        # Escape buyer name for V2
+        buyer_name_escaped = utility.escape_markdown_v2(
+            f"@{user.username}" if user.username else (user.first_name or str(user.id))
         )
+        # Escape price string just in case it contains '.' or other chars (though unlikely for price_str)
+        price_str_escaped = utility.escape_markdown_v2(price_str)
 
-        # Notify Seller
-        try:
-            # Escape buyer name for V2
-            buyer_name_escaped = utility.escape_markdown_v2(f"@{user.username}" or user.first_name)
-            # Escape price string just in case it contains '.' or other chars (though unlikely for price_str)
-            price_str_escaped = utility.escape_markdown_v2(price_str)
-
-            seller_confirm_button = InlineKeyboardButton(
-                "✅ تایید دریافت وجه",
-                callback_data=f'seller_confirm_{listing_id}'
-            )
-            seller_reject_button = InlineKeyboardButton(
-                "❌ رد کردن / لغو",
-                callback_data=f'{CALLBACK_SELLER_REJECT_PENDING}_{listing_id}'
-            )
-            seller_markup = InlineKeyboardMarkup([[seller_confirm_button, seller_reject_button]])
-
-            seller_message = (
-                f"🔔 درخواست خرید جدید برای آگهی شما\\!\n\n"
-                # Escape the parentheses around meal_desc_escaped -> \\( ... \\)
-                f"آگهی: `{listing_id}` \\({utility.escape_markdown_v2(raw_meal_description)}\\)\n"
-                f"خریدار: {buyer_name_escaped} \\(ID: `{user.id}`\\)\n"
-                f"مبلغ: {price_str_escaped} تومان\n\n"
-                f"خریدار اطلاعات کارت شما را دریافت کرد\\. لطفا *پس از دریافت وجه*، دکمه 'تایید دریافت وجه' را بزنید\\.\n"
-                f"در صورت عدم تمایل به فروش به این کاربر یا مشکل دیگر، دکمه 'رد کردن / لغو' را بزنید\\."
-            )
+        seller_confirm_button = InlineKeyboardButton(
+            "✅ تایید دریافت وجه",
+            callback_data=f'seller_confirm_{listing_id}'
+        )
+        seller_reject_button = InlineKeyboardButton(
+            "❌ رد کردن / لغو",
+            callback_data=f'{CALLBACK_SELLER_REJECT_PENDING}_{listing_id}'
+        )
+        seller_markup = InlineKeyboardMarkup([[seller_confirm_button, seller_reject_button]])
+
+        seller_message = (
+            f"🔔 درخواست خرید جدید برای آگهی شما\\!\n\n"
+            # Escape the parentheses around meal_desc_escaped -> \\( ... \\)
+            f"آگهی: `{listing_id}` \\({utility.escape_markdown_v2(raw_meal_description)}\\)\n"
+            f"خریدار: {buyer_name_escaped} \\(ID: `{user.id}`\\)\n"
+            f"مبلغ: {price_str_escaped} تومان\n\n"
+            f"خریدار اطلاعات کارت شما را دریافت کرد\\. لطفا *پس از دریافت وجه*، دکمه 'تایید دریافت وجه' را بزنید\\.\n"
+            f"در صورت عدم تمایل به فروش به این کاربر یا مشکل دیگر، دکمه 'رد کردن / لغو' را بزنید\\."
+        )
 
-            # Send notification to seller
-            await context.bot.send_message(
+        # When sending this message, use ParseMode.MARKDOWN_V2
+        logger.debug("BUYER MESSAGE (handle_confirm_purchase) constructed: %s", buyer_message)
+        # Buyer edit and seller notification go to different chats, so send them concurrently
+        buyer_result, seller_result = await asyncio.gather(
+            query.edit_message_text(
+                text=buyer_message,
+                parse_mode=ParseMode.MARKDOWN_V2,
+                reply_markup=buyer_markup
+            ),
+            context.bot.send_message(
                 chat_id=seller_telegram_id,
                 text=seller_message,
                 reply_markup=seller_markup,
                 parse_mode=ParseMode.MARKDOWN_V2
-            )
-            logger.info(f"Notified seller {seller_telegram_id} about pending sale {listing_id}")
-        except BadRequest as e:
-            # Log the V2 specific error
-            logger.error(f"Failed to notify seller {seller_telegram_id} for pending sale {listing_id} using V2: {e}", exc_info=True)
+            ),
+            return_exceptions=True
+        )
+
+        # Notify Seller (result handling)
+        if not isinstance(seller_result, Exception):
+            logger.info("Notified seller %s about pending sale %s", seller_telegram_id, listing_id)
+        elif isinstance(seller_result, BadRequest):
+            # Log the V2 specific error; Telegram's message already names the cause, a traceback adds nothing
+            logger.error("Failed to notify seller %s for pending sale %s using V2: %s", seller_telegram_id, listing_id, seller_result)
             # Try sending a fallback simple message (without markdown)
             try:
-                fallback_text = f"درخواست خرید جدید برای آگهی {listing_id} از کاربر {user.first_name or user.id}. لطفا برای تایید یا رد به ربات مراجعه کنید."
+                fallback_text = SELLER_PENDING_FALLBACK_TEMPLATE.format(listing_id=listing_id, buyer=user.first_name or user.id)
                 await context.bot.send_message(chat_id=seller_telegram_id, text=fallback_text)
             except Exception as fallback_err:
-                logger.error(f"Failed to send even fallback notification to seller {seller_telegram_id}: {fallback_err}")
-        except Exception as notify_err:
-            logger.error(
-                f"Unexpected error notifying seller {seller_telegram_id} for pending sale {listing_id}: {notify_err}",
-                exc_info=True)
+                logger.error("Failed to send even fallback notification to seller %s: %s", seller_telegram_id, fallback_err)
+        else:
+            if isinstance(seller_result, Forbidden):
+                # Expected when the seller blocked the bot; no traceback needed
+                logger.warning("Failed to notify seller %s for pending sale %s: %s", seller_telegram_id, listing_id, seller_result)
+            else:
+                logger.error(
+                    "Unexpected error notifying seller %s for pending sale %s: %s", seller_telegram_id, listing_id, seller_result,
+                    exc_info=seller_result)
             # Inform buyer about the notification failure
             await context.bot.send_message(user.id, "خطا در ارسال پیام به فروشنده. لطفا با پشتیبانی تماس بگیرید.")
+
+        if isinstance(buyer_result, Exception):
+            # Surface buyer-side failures to the global error handler, as before
+            raise buyer_result
     else:
         # Handle failure: edit buyer's original message if possible
         try:
             await query.edit_message_text(error_message)
         except Exception as edit_err:
-            logger.error(f"Failed to edit buyer message after purchase confirmation failure: {edit_err}")
+            logger.error("Failed to edit buyer message after purchase confirmation failure: %s", edit_err)
 
 
 async def handle_cancel_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles the 'Cancel' button press during purchase confirmation."""
     query = update.callback_query
     user = update.effective_user
-    await query.answer() # Answer callback
 
-    logger.info(f"User {user.id} canceled purchase process.")
-    # Edit message back or simply confirm cancellation
-    await query.edit_message_text(
-        "خرید لغو شد. برای مشاهده مجدد لیست غذاها، دکمه 'خرید غذا' را بزنید.", # Purchase canceled. To see list again, press 'Buy Food'.
-        reply_markup=None # Remove confirmation buttons
-        )
+    logger.info("User %s canceled purchase process.", user.id)
+    # The edit is still needed to remove the confirmation buttons, but it doesn't depend on
+    # the callback answer, so both requests go out concurrently
+    await asyncio.gather(
+        query.answer(), # Answer callback
+        query.edit_message_text(
+            "خرید لغو شد. برای مشاهده مجدد لیست غذاها، دکمه 'خرید غذا' را بزنید.", # Purchase canceled. To see list again, press 'Buy Food'.
+            reply_markup=None # Remove confirmation buttons
+        ),
+    )
 
 
+BUYER_CANCEL_FAILURE_MESSAGES = {
+    crud.PendingActionFailureReason.LISTING_NOT_FOUND: "آگهی یافت نشد.",
+    crud.PendingActionFailureReason.NOT_PENDING: "این درخواست دیگر در انتظار تایید نیست.",
+    crud.PendingActionFailureReason.NOT_PARTICIPANT: "شما درخواست‌دهنده این خرید نیستید.",
+}
+
 async def handle_buyer_cancel_pending(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles the buyer cancelling a purchase in AWAITING_CONFIRMATION state."""
     query = update.callback_query
     user = update.effective_user # Buyer
-    await query.answer("در حال لغو درخواست...")
-
-    if not query.data: return
+    # The answer's round trip overlaps the DB work below
+    ack_task = asyncio.create_task(query.answer("در حال لغو درخواست..."))
 
-    try:
-        listing_id = int(query.data.split('_')[-1])
-    except (ValueError, IndexError):
-        logger.error(f"Invalid callback data for buyer cancel pending: {query.data}")
+    match = match_callback(context, BUYER_CANCEL_PENDING_PATTERN, query.data)
+    if not match:
+        logger.error("Invalid callback data for buyer cancel pending: %s", query.data)
+        await _await_callback_answer(ack_task)
         await query.edit_message_text("خطای داخلی: دکمه نامعتبر.")
         return
+    listing_id = int(match[1])
 
-    logger.info(f"Buyer {user.id} initiated cancellation for pending listing {listing_id}")
+    logger.info("Buyer %s initiated cancellation for pending listing %s", user.id, listing_id)
 
     updated_listing: models.Listing | None = None
     seller_tg_id: int | None = None
@@ -579,33 +667,28 @@ async def handle_buyer_cancel_pending(update: Update, context: ContextTypes.DEFA
 
     try:
         async with get_db_session() as db_session:
-            updated_listing, seller_tg_id = await crud.cancel_pending_purchase_by_buyer(
+            updated_listing, seller_tg_id, failure_reason = await crud.cancel_pending_purchase_by_buyer(
                 db=db_session,
                 listing_id=listing_id,
                 buyer_telegram_id=user.id
             )
             if not updated_listing:
-                # Check specific reasons if needed, e.g., listing not found or not pending
-                listing_check = await crud.get_listing_by_id(db_session, listing_id)
-                if not listing_check: error_message = "آگهی یافت نشد."
-                elif listing_check.status != models.ListingStatus.AWAITING_CONFIRMATION: error_message="این درخواست دیگر در انتظار تایید نیست."
-                elif listing_check.pending_buyer_id != user.id: error_message="شما درخواست‌دهنده این خرید نیستید."
+                # The CRUD call already knows why it failed; no need to re-query the listing
+                error_message = BUYER_CANCEL_FAILURE_MESSAGES.get(failure_reason, error_message)
 
     except Exception as e:
-        logger.error(f"Error handling buyer cancellation for listing {listing_id}: {e}", exc_info=True)
+        logger.error("Error handling buyer cancellation for listing %s: %s", listing_id, e, exc_info=True)
         error_message = "خطای جدی هنگام لغو رخ داد."
 
+    await _await_callback_answer(ack_task)
+
     if updated_listing:
-        # Edit buyer's message
         meal_desc = updated_listing.meal.description if updated_listing.meal else "غذا"
-        await query.edit_message_text(
-            f"✅ درخواست خرید شما برای آگهی `{listing_id}` ({meal_desc}) لغو شد.\n"
-            f"این آگهی مجددا در دسترس قرار گرفت.",
-            parse_mode=ParseMode.MARKDOWN,
-            reply_markup=None # Remove buttons
-        )
-        # Notify Seller
-        if seller_tg_id:
+
+        async def _notify_seller() -> None:
+            if not seller_tg_id:
+                logger.warning("Seller TG ID not found for notification on buyer cancellation of listing %s", listing_id)
+                return
             try:
                 seller_message = (
                     f"❌ خریدار درخواست خرید برای آگهی `{listing_id}` ({meal_desc}) را لغو کرد.\n"
@@ -616,35 +699,50 @@ async def handle_buyer_cancel_pending(update: Update, context: ContextTypes.DEFA
                     text=seller_message,
                     parse_mode=ParseMode.MARKDOWN
                 )
-                logger.info(f"Notified seller {seller_tg_id} about buyer cancellation for listing {listing_id}")
+                logger.info("Notified seller %s about buyer cancellation for listing %s", seller_tg_id, listing_id)
             except (Forbidden, BadRequest) as e:
-                logger.warning(f"Failed to notify seller {seller_tg_id} about buyer cancellation for {listing_id}: {e}")
+                logger.warning("Failed to notify seller %s about buyer cancellation for %s: %s", seller_tg_id, listing_id, e)
             except Exception as notify_err:
-                logger.error(f"Unexpected error notifying seller {seller_tg_id} about buyer cancellation for {listing_id}: {notify_err}", exc_info=True)
-        else:
-            logger.warning(f"Seller TG ID not found for notification on buyer cancellation of listing {listing_id}")
+                logger.error("Unexpected error notifying seller %s about buyer cancellation for %s: %s", seller_tg_id, listing_id, notify_err, exc_info=True)
+
+        # Buyer edit and seller notification go to different chats, so send them concurrently
+        await asyncio.gather(
+            query.edit_message_text(
+                f"✅ درخواست خرید شما برای آگهی `{listing_id}` ({meal_desc}) لغو شد.\n"
+                f"این آگهی مجددا در دسترس قرار گرفت.",
+                parse_mode=ParseMode.MARKDOWN,
+                reply_markup=None # Remove buttons
+            ),
+            _notify_seller(),
+        )
 
     else:
         # Failed to cancel, inform buyer via editing their message
         await query.edit_message_text(f"⚠️ {error_message}\nلطفا وضعیت را بررسی کنید یا با پشتیبانی تماس بگیرید.", reply_markup=None)
 
 
+SELLER_REJECT_FAILURE_MESSAGES = {
+    crud.PendingActionFailureReason.LISTING_NOT_FOUND: "آگهی یافت نشد.",
+    crud.PendingActionFailureReason.NOT_PENDING: "این درخواست دیگر در انتظار تایید نیست.",
+    crud.PendingActionFailureReason.NOT_PARTICIPANT: "شما فروشنده این آگهی نیستید.",
+}
+
 async def handle_seller_reject_pending(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles the seller rejecting/cancelling a purchase in AWAITING_CONFIRMATION state."""
     query = update.callback_query
     user = update.effective_user # Seller
-    await query.answer("در حال رد کردن درخواست...")
+    # The answer's round trip overlaps the DB work below
+    ack_task = asyncio.create_task(query.answer("در حال رد کردن درخواست..."))
 
-    if not query.data: return
-
-    try:
-        listing_id = int(query.data.split('_')[-1])
-    except (ValueError, IndexError):
-        logger.error(f"Invalid callback data for seller reject pending: {query.data}")
+    match = match_callback(context, SELLER_REJECT_PENDING_PATTERN, query.data)
+    if not match:
+        logger.error("Invalid callback data for seller reject pending: %s", query.data)
+        await _await_callback_answer(ack_task)
         await query.edit_message_text("خطای داخلی: دکمه نامعتبر.")
         return
+    listing_id = int(match[1])
 
-    logger.info(f"Seller {user.id} initiated rejection for pending listing {listing_id}")
+    logger.info("Seller %s initiated rejection for pending listing %s", user.id, listing_id)
 
     updated_listing: models.Listing | None = None
     buyer_tg_id: int | None = None
@@ -652,33 +750,28 @@ async def handle_seller_reject_pending(update: Update, context: ContextTypes.DEF
 
     try:
         async with get_db_session() as db_session:
-            updated_listing, buyer_tg_id = await crud.reject_pending_purchase_by_seller(
+            updated_listing, buyer_tg_id, failure_reason = await crud.reject_pending_purchase_by_seller(
                 db=db_session,
                 listing_id=listing_id,
                 seller_telegram_id=user.id
             )
             if not updated_listing:
-                # Check specific reasons if needed
-                listing_check = await crud.get_listing_by_id(db_session, listing_id)
-                if not listing_check: error_message = "آگهی یافت نشد."
-                elif listing_check.status != models.ListingStatus.AWAITING_CONFIRMATION: error_message="این درخواست دیگر در انتظار تایید نیست."
-                elif listing_check.seller_id != user.id: error_message="شما فروشنده این آگهی نیستید."
+                # The CRUD call already knows why it failed; no need to re-query the listing
+                error_message = SELLER_REJECT_FAILURE_MESSAGES.get(failure_reason, error_message)
 
     except Exception as e:
-        logger.error(f"Error handling seller rejection for listing {listing_id}: {e}", exc_info=True)
+        logger.error("Error handling seller rejection for listing %s: %s", listing_id, e, exc_info=True)
         error_message = "خطای جدی هنگام رد کردن رخ داد."
 
+    await _await_callback_answer(ack_task)
+
     if updated_listing:
-        # Edit seller's message
         meal_desc = updated_listing.meal.description if updated_listing.meal else "غذا"
-        await query.edit_message_text(
-            f"✅ درخواست خرید برای آگهی `{listing_id}` ({meal_desc}) توسط شما رد/لغو شد.\n"
-            f"این آگهی مجددا در دسترس قرار گرفت.",
-            parse_mode=ParseMode.MARKDOWN,
-            reply_markup=None # Remove buttons
-        )
-        # Notify Buyer
-        if buyer_tg_id:
+
+        async def _notify_buyer() -> None:
+            if not buyer_tg_id:
+                logger.warning("Buyer TG ID not found for notification on seller rejection of listing %s", listing_id)
+                return
             try:
                 buyer_message = (
                     f"❌ متاسفانه فروشنده درخواست خرید شما برای آگهی `{listing_id}` ({meal_desc}) را رد/لغو کرد.\n"
@@ -689,32 +782,62 @@ async def handle_seller_reject_pending(update: Update, context: ContextTypes.DEF
                     text=buyer_message,
                     parse_mode=ParseMode.MARKDOWN
                 )
-                logger.info(f"Notified buyer {buyer_tg_id} about seller rejection for listing {listing_id}")
+                logger.info("Notified buyer %s about seller rejection for listing %s", buyer_tg_id, listing_id)
             except (Forbidden, BadRequest) as e:
-                logger.warning(f"Failed to notify buyer {buyer_tg_id} about seller rejection for {listing_id}: {e}")
+                logger.warning("Failed to notify buyer %s about seller rejection for %s: %s", buyer_tg_id, listing_id, e)
             except Exception as notify_err:
-                logger.error(f"Unexpected error notifying buyer {buyer_tg_id} about seller rejection for {listing_id}: {notify_err}", exc_info=True)
-        else:
-            logger.warning(f"Buyer TG ID not found for notification on seller rejection of listing {listing_id}")
+                logger.error("Unexpected error notifying buyer %s about seller rejection for %s: %s", buyer_tg_id, listing_id, notify_err, exc_info=True)
+
+        # Seller edit and buyer notification go to different chats, so send them concurrently
+        await asyncio.gather(
+            query.edit_message_text(
+                f"✅ درخواست خرید برای آگهی `{listing_id}` ({meal_desc}) توسط شما رد/لغو شد.\n"
+                f"این آگهی مجددا در دسترس قرار گرفت.",
+                parse_mode=ParseMode.MARKDOWN,
+                reply_markup=None # Remove buttons
+            ),
+            _notify_buyer(),
+        )
     else:
         # Failed to reject, inform seller via editing their message
         await query.edit_message_text(f"⚠️ {error_message}\nلطفا وضعیت را بررسی کنید یا با پشتیبانی تماس بگیرید.", reply_markup=None)
 
 
+# Static parts of the sale-confirmed messages are escaped once here; only the listing id
+# and reservation code are filled in per callback.
+SELLER_CONFIRMED_MESSAGE_TEMPLATE = (
+    utility.escape_markdown_v2("✅ دریافت وجه برای آگهی ") + "`{listing_id}`"
+    + utility.escape_markdown_v2(" تایید شد.\nکد و بارکد برای خریدار ارسال می‌شود.")
+)
+BUYER_SALE_CAPTION_TEMPLATE = (
+    utility.escape_markdown_v2("✅ پرداخت شما برای آگهی ") + "`{listing_id}`"
+    + utility.escape_markdown_v2(" تایید شد!\n\nکد رزرو شما: ") + "`{reservation_code}`"
+    + utility.escape_markdown_v2("\n\nمی‌توانید از بارکد بالا یا کد برای دریافت غذا استفاده کنید.")
+)
+
+
+SELLER_CONFIRM_FAILURE_MESSAGES = {
+    crud.PendingActionFailureReason.LISTING_NOT_FOUND: "آگهی یافت نشد.",
+    crud.PendingActionFailureReason.NOT_PARTICIPANT: "شما فروشنده این آگهی نیستید.",
+    crud.PendingActionFailureReason.ALREADY_SOLD: "فروش قبلا نهایی شده.",
+    crud.PendingActionFailureReason.NOT_PENDING: "وضعیت آگهی قابل تایید نیست.",
+    crud.PendingActionFailureReason.DB_ERROR: "خطا در بروزرسانی وضعیت.",
+}
+
 async def handle_seller_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles seller confirmation, calls finalize, sends code to buyer."""
     query = update.callback_query
     user = update.effective_user
     await query.answer("در حال تایید...")
 
-    try:
-        listing_id = int(query.data.split('_')[-1])
-    except:
-        logger.error(f"Invalid callback data for seller confirmation: {query.data}")
-        await query.edit_message_text("خطا: دکمه نامعتبر.");
+    match = match_callback(context, SELLER_CONFIRM_PATTERN, query.data)
+    if not match:
+        logger.error("Invalid callback data for seller confirmation: %s", query.data)
+        await query.edit_message_text("خطا: دکمه نامعتبر.")
         return
+    listing_id = int(match[1])
 
-    logger.info(f"Seller {user.id} confirmed payment for listing {listing_id}")
+    logger.info("Seller %s confirmed payment for listing %s", user.id, listing_id)
 
     # Finalize Sale Logic
     finalized_listing: models.Listing | None = None
@@ -725,118 +848,90 @@ async def handle_seller_confirmation(update: Update, context: ContextTypes.DEFAU
     try:  # INNER TRY BLOCK
         async with get_db_session() as db_session:
             # Call finalize_listing_sale
-            finalized_listing, reservation_code = await crud.finalize_listing_sale(
+            finalized_listing, reservation_code, buyer_telegram_id, failure_reason = await crud.finalize_listing_sale(
                 db=db_session, listing_id=listing_id, confirming_seller_telegram_id=user.id
             )
 
-            if finalized_listing and finalized_listing.buyer:  # Ensure buyer is loaded
-                buyer_telegram_id = finalized_listing.buyer.telegram_id
-            elif not finalized_listing:
-                listing_check = await crud.get_listing_by_id(db_session, listing_id)
-                if not listing_check:
-                    error_message = "آگهی یافت نشد."
-                elif not listing_check.seller or listing_check.seller.telegram_id != user.id:
-                    error_message = "شما فروشنده این آگهی نیستید."
-                elif listing_check.status == models.ListingStatus.SOLD:
-                    error_message = "فروش قبلا نهایی شده."
-                elif listing_check.status != models.ListingStatus.AWAITING_CONFIRMATION:
-                    error_message = f"وضعیت آگهی ({listing_check.status.value}) قابل تایید نیست."
-                else:
-                    error_message = "خطا در بروزرسانی وضعیت."
-
+        if not finalized_listing:
+            # The reason comes from finalize's own checks; no second lookup of the listing
+            error_message = SELLER_CONFIRM_FAILURE_MESSAGES.get(failure_reason, error_message)
 
     except Exception as e:
         logger.error(
-            f"Caught exception during finalize process for listing {listing_id}. Type: {type(e)}, Error: {str(e)}",
+            "Caught exception during finalize process for listing %s. Type: %s, Error: %s", listing_id, type(e), e,
             exc_info=True
         )
         error_message = "خطای جدی در سرور رخ داد."
         finalized_listing = None
     if finalized_listing and buyer_telegram_id and reservation_code:
-        text_part_seller_1 = f"✅ دریافت وجه برای آگهی "
-        text_part_seller_2_id = f"`{listing_id}`"  # listing_id is int, safe in backticks
-        text_part_seller_3 = f" تایید شد.\nکد و بارکد برای خریدار ارسال می‌شود."
-
-        escaped_success_edit_text = (
-            f"{utility.escape_markdown_v2(text_part_seller_1)}"
-            f"{text_part_seller_2_id}"  # listing_id is an int, safe in backticks
-            f"{utility.escape_markdown_v2(text_part_seller_3)}"  # This will escape the periods
-        )
+        escaped_success_edit_text = SELLER_CONFIRMED_MESSAGE_TEMPLATE.format(listing_id=listing_id)
 
-        logger.info(
-            f"SELLER MSG EDIT (SUCCESS): Attempting to edit seller's message to: {escaped_success_edit_text}")  # YOUR ADDED LOG
-        try:
-            await query.edit_message_text(
-                text=escaped_success_edit_text,
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
-            logger.info("SELLER MSG EDIT (SUCCESS): Successfully edited seller's message.")
-        except Exception as e_edit_seller_success:
-            logger.error(f"SELLER MSG EDIT (SUCCESS): FAILED to edit seller's message: {e_edit_seller_success}",
-                         exc_info=True)
-
-        barcode_image_bytes = utility.generate_qr_code_image(data=reservation_code)
-
-        # Construct the caption, escaping static parts
-        # Part 1
-        text_part1 = f"✅ پرداخت شما برای آگهی "
-        # Part 2 (dynamic listing_id, already safe in backticks)
-        text_part2_listing_id = f"`{listing_id}`"
-        # Part 3
-        text_part3 = f" تایید شد!\n\nکد رزرو شما: "
-        # Part 4 (dynamic reservation_code, ensure it's escaped if it can contain special chars)
-        # The backticks around it are Markdown syntax.
-        text_part4_code = f"`{utility.escape_markdown_v2(str(reservation_code))}`"
-        # Part 5
-        text_part5 = f"\n\nمی‌توانید از بارکد بالا یا کد برای دریافت غذا استفاده کنید."
-
-        buyer_message_caption = (
-            f"{utility.escape_markdown_v2(text_part1)}"
-            f"{text_part2_listing_id}"  # listing_id is int, safe in backticks
-            f"{utility.escape_markdown_v2(text_part3)}"
-            f"{text_part4_code}"  # Code is already escaped and in backticks
-            f"{utility.escape_markdown_v2(text_part5)}"
+        async def _edit_seller_message() -> None:
+            # %-style: the message text is only interpolated if INFO is enabled
+            logger.info(
+                "SELLER MSG EDIT (SUCCESS): Attempting to edit seller's message to: %s", escaped_success_edit_text)  # YOUR ADDED LOG
+            try:
+                await query.edit_message_text(
+                    text=escaped_success_edit_text,
+                    parse_mode=ParseMode.MARKDOWN_V2
+                )
+                logger.info("SELLER MSG EDIT (SUCCESS): Successfully edited seller's message.")
+            except Exception as e_edit_seller_success:
+                logger.error("SELLER MSG EDIT (SUCCESS): FAILED to edit seller's message: %s", e_edit_seller_success,
+                             exc_info=True)
+
+        buyer_message_caption = BUYER_SALE_CAPTION_TEMPLATE.format(
+            listing_id=listing_id,
+            reservation_code=utility.escape_markdown_v2(str(reservation_code)),
         )
 
-        try:
-            if barcode_image_bytes:
-                await context.bot.send_photo(
-                    chat_id=buyer_telegram_id,
-                    photo=io.BytesIO(barcode_image_bytes),
-                    caption=buyer_message_caption,
-                    parse_mode=ParseMode.MARKDOWN_V2,
-                    reply_markup=get_main_menu_keyboard()
-                )
-                logger.info(f"Sent QR code and text for listing {listing_id} to buyer {buyer_telegram_id}")
-            else:
-                # Fallback
-                logger.error(f"Barcode generation failed for listing {listing_id}. Sending text code only.")
-                # If sending text only, and the text is the same caption, it also needs to be escaped for V2
-                await context.bot.send_message(
-                    chat_id=buyer_telegram_id,
-                    text=buyer_message_caption,  # Use the same fully escaped caption
-                    parse_mode=ParseMode.MARKDOWN_V2,
-                    reply_markup=get_main_menu_keyboard()
-                )
-        except Exception as notify_err:
-            logger.error(
-                f"Failed to send code/photo to buyer {buyer_telegram_id} for listing {listing_id}: {notify_err}",
-                exc_info=True)
+        async def _send_code_to_buyer() -> bool:
+            # QR rendering is CPU-bound, so run it in a worker thread (off the event loop)
+            barcode_image_bytes = await asyncio.to_thread(utility.generate_qr_code_image, reservation_code)
+            try:
+                if barcode_image_bytes:
+                    await context.bot.send_photo(
+                        chat_id=buyer_telegram_id,
+                        photo=barcode_image_bytes,  # PTB wraps raw bytes in an InputFile itself
+                        caption=buyer_message_caption,
+                        parse_mode=ParseMode.MARKDOWN_V2,
+                        reply_markup=get_main_menu_keyboard()
+                    )
+                    logger.info("Sent QR code and text for listing %s to buyer %s", listing_id, buyer_telegram_id)
+                else:
+                    # Fallback
+                    logger.error("Barcode generation failed for listing %s. Sending text code only.", listing_id)
+                    # If sending text only, and the text is the same caption, it also needs to be escaped for V2
+                    await context.bot.send_message(
+                        chat_id=buyer_telegram_id,
+                        text=buyer_message_caption,  # Use the same fully escaped caption
+                        parse_mode=ParseMode.MARKDOWN_V2,
+                        reply_markup=get_main_menu_keyboard()
+                    )
+                return True
+            except (Forbidden, BadRequest) as notify_err:
+                logger.warning("Failed to send code/photo to buyer %s for listing %s: %s", buyer_telegram_id, listing_id, notify_err)
+            except Exception as notify_err:
+                logger.error(
+                    "Failed to send code/photo to buyer %s for listing %s: %s", buyer_telegram_id, listing_id, notify_err,
+                    exc_info=True)
+            return False
+
+        # The buyer's code and the seller's edit are independent Bot API calls; run them concurrently
+        buyer_notified, _ = await asyncio.gather(_send_code_to_buyer(), _edit_seller_message())
+        if not buyer_notified:
             # Inform seller about the failure
             await context.bot.send_message(user.id,
                                            f"پرداخت تایید شد، اما در ارسال کد به خریدار آگهی {listing_id} مشکلی پیش آمد. لطفا کد `{reservation_code}` را دستی برای او ارسال کنید.")
 
     else:  # finalization failed or data missing
-        error_edit_text = utility.escape_markdown_v2(error_message)
+        # The error text has no formatting, so send it as plain text: nothing to escape or parse
         logger.info(
-            f"SELLER MSG EDIT (FAILURE): Attempting to edit seller's message to: {error_edit_text}")  # YOUR ADDED LOG
+            "SELLER MSG EDIT (FAILURE): Attempting to edit seller's message to: %s", error_message)  # YOUR ADDED LOG
         try:
-            await query.edit_message_text(
-                error_edit_text,
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
+            await query.edit_message_text(error_message)
             logger.info("SELLER MSG EDIT (FAILURE): Successfully edited seller's message with error.")
         except Exception as e_edit_seller_failure:
             logger.error(
-                f"SELLER MSG EDIT (FAILURE): FAILED to edit seller's message with error: {e_edit_seller_failure}",
+                "SELLER MSG EDIT (FAILURE): FAILED to edit seller's message with error: %s", e_edit_seller_failure,
                 exc_info=True)
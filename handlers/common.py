@@ -1,5 +1,10 @@
 import logging
-from telegram import ReplyKeyboardMarkup, KeyboardButton
+import re
+from collections import OrderedDict
+from functools import lru_cache
+
+from telegram import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup
+from telegram.ext import ContextTypes
 
 logger = logging.getLogger(__name__)
 
@@ -30,12 +35,13 @@ BTN_SELL_FOOD = "🏷️ فروش غذا"
 BTN_MY_LISTINGS = "📄 لیست آگهی‌های من"
 BTN_HISTORY = "📜 تاریخچه معاملات"
 BTN_SETTINGS = "⚙️ تنظیمات"
-MAIN_MENU_BUTTON_TEXTS = {BTN_BUY_FOOD, BTN_SELL_FOOD, BTN_MY_LISTINGS, BTN_SETTINGS, BTN_HISTORY}
+MAIN_MENU_BUTTON_TEXTS = frozenset({BTN_BUY_FOOD, BTN_SELL_FOOD, BTN_MY_LISTINGS, BTN_SETTINGS, BTN_HISTORY})
 
 
 # Helper Function for Main Menu Keyboard
+@lru_cache(maxsize=1)
 def get_main_menu_keyboard() -> ReplyKeyboardMarkup:
-    """Returns the main ReplyKeyboardMarkup."""
+    """Returns the main ReplyKeyboardMarkup. Built once and shared (PTB markup objects are immutable)."""
     keyboard = [
         [KeyboardButton(BTN_BUY_FOOD), KeyboardButton(BTN_SELL_FOOD)],
         [KeyboardButton(BTN_MY_LISTINGS), KeyboardButton(BTN_SETTINGS)],
@@ -48,4 +54,46 @@ def get_main_menu_keyboard() -> ReplyKeyboardMarkup:
         input_field_placeholder="گزینه مورد نظر را انتخاب کنید..."
     )
 
+
+def match_callback(context: ContextTypes.DEFAULT_TYPE, pattern: re.Pattern, data: str | None) -> re.Match | None:
+    """
+    Returns the match CallbackQueryHandler already made when it routed this callback by `pattern`,
+    so the callback data isn't parsed twice; falls back to matching `data` directly.
+    """
+    if context.matches and context.matches[0].re is pattern:
+        return context.matches[0]
+    return pattern.match(data or '')
+
+
+class RenderedMessageCache:
+    """
+    Remembers a hash of the text and button data last shown in each (chat_id, message_id),
+    so a refresh that would render the same message can skip the Bot API edit. LRU-bounded.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._hashes: OrderedDict[tuple[int, int], int] = OrderedDict()
+
+    @staticmethod
+    def render_hash(text: str, reply_markup: InlineKeyboardMarkup | None) -> int:
+        button_data = tuple(b.callback_data for row in reply_markup.inline_keyboard for b in row) if reply_markup else ()
+        return hash((text, button_data))
+
+    def is_shown(self, chat_id: int, message_id: int, render_hash: int) -> bool:
+        """True if the message already shows this render."""
+        key = (chat_id, message_id)
+        if self._hashes.get(key) != render_hash:
+            return False
+        self._hashes.move_to_end(key)
+        return True
+
+    def remember(self, chat_id: int, message_id: int, render_hash: int) -> None:
+        """Records the render now shown in the message (after a send, an edit or 'Message is not modified')."""
+        key = (chat_id, message_id)
+        self._hashes[key] = render_hash
+        self._hashes.move_to_end(key)
+        if len(self._hashes) > self.max_size:
+            self._hashes.popitem(last=False)
+
 # logger.debug("Common handlers definitions loaded.")
\ No newline at end of file
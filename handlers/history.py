@@ -1,5 +1,5 @@
 import logging
-import math
+import re
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
@@ -7,7 +7,7 @@ from telegram.ext import ContextTypes
 
 from utility import format_gregorian_date_to_shamsi, escape_markdown_v2
 from .common import (
-    MAIN_MENU_BUTTON_TEXTS
+    MAIN_MENU_BUTTON_TEXTS, match_callback
 )
 from config import HISTORY_PAGE_SIZE
 from self_market.db.session import get_db_session
@@ -16,6 +16,29 @@ from self_market import models
 
 logger = logging.getLogger(__name__)
 
+# history_<type>_<page>; bot.py routes handle_history_view with this same compiled pattern
+HISTORY_VIEW_PATTERN = re.compile(r'^history_(purchases|sales)_(\d+)$')
+
+# Static keyboards and texts, built once instead of on every history render
+HISTORY_SELECT_TEXT = "📜 کدام تاریخچه را می‌خواهید مشاهده کنید؟"
+HISTORY_SELECT_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🛒 خرید‌های من", callback_data='history_purchases_0'), # Start on page 0
+        InlineKeyboardButton("🏷️ فروش‌های من", callback_data='history_sales_0') # Start on page 0
+    ],
+    [InlineKeyboardButton("🔙 بازگشت به منوی اصلی", callback_data='settings_back_main')] # Re-use back handler
+])
+HISTORY_BACK_SELECT_BUTTON = InlineKeyboardButton("🔙 بازگشت به انتخاب نوع", callback_data='history_back_select')
+HISTORY_BACK_SELECT_MARKUP = InlineKeyboardMarkup([[HISTORY_BACK_SELECT_BUTTON]])
+# Appended when rows had to be dropped to stay under Telegram's 4096-char message limit
+HISTORY_TRUNCATED_NOTE = "...\n"
+HISTORY_MESSAGE_MAX_LENGTH = 4096 - len(HISTORY_TRUNCATED_NOTE)
+# history type -> (title, message shown when there is nothing to list)
+HISTORY_TITLES = {
+    'purchases': ("**🛒 تاریخچه خرید‌های شما**", "سابقه خریدی برای شما ثبت نشده است."),
+    'sales': ("**🏷️ تاریخچه فروش‌های شما**", "سابقه فروشی برای شما ثبت نشده است."),
+}
+
 # History Handlers
 async def handle_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles the 'Transaction History' button, prompts for type."""
@@ -23,7 +46,7 @@ async def handle_history(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     message = update.message
     if not user or not message: return
 
-    logger.info(f"'Transaction History' button pressed by user {user.id}")
+    logger.info("'Transaction History' button pressed by user %s", user.id)
 
     # Check verification status if history is restricted
     async with get_db_session() as db_session:
@@ -32,17 +55,9 @@ async def handle_history(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
            await message.reply_text("برای مشاهده تاریخچه، ابتدا باید اعتبارسنجی شوید (/start).")
            return
 
-    keyboard = [
-        [
-            InlineKeyboardButton("🛒 خرید‌های من", callback_data='history_purchases_0'), # Start on page 0
-            InlineKeyboardButton("🏷️ فروش‌های من", callback_data='history_sales_0') # Start on page 0
-        ],
-        [InlineKeyboardButton("🔙 بازگشت به منوی اصلی", callback_data='settings_back_main')] # Re-use back handler
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
     await message.reply_text(
-        "📜 کدام تاریخچه را می‌خواهید مشاهده کنید؟",
-        reply_markup=reply_markup
+        HISTORY_SELECT_TEXT,
+        reply_markup=HISTORY_SELECT_MARKUP
     )
 
 async def handle_history_view(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -54,17 +69,16 @@ async def handle_history_view(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     await query.answer()
 
-    # Parse Callback Data
-    try:
-        parts = query.data.split('_')
-        history_type = parts[1] # 'purchases' or 'sales'
-        page = int(parts[2])    # Current page number
-    except (IndexError, ValueError):
-        logger.error(f"Invalid callback data for history view: {query.data}")
+    # Parse Callback Data, reusing the match CallbackQueryHandler made when routing by HISTORY_VIEW_PATTERN
+    match = match_callback(context, HISTORY_VIEW_PATTERN, query.data)
+    if not match:
+        logger.error("Invalid callback data for history view: %s", query.data)
         await query.edit_message_text("خطای داخلی: دکمه نامعتبر.")
         return
+    history_type = match[1] # 'purchases' or 'sales'
+    page = int(match[2])    # Current page number
 
-    logger.info(f"User {user.id} viewing history: type={history_type}, page={page}")
+    logger.info("User %s viewing history: type=%s, page=%s", user.id, history_type, page)
 
     # Fetch Data
     listings = []
@@ -75,39 +89,32 @@ async def handle_history_view(update: Update, context: ContextTypes.DEFAULT_TYPE
                 listings, total_count = await crud.get_user_purchase_history(
                     db=db_session, user_telegram_id=user.id, page=page, page_size=HISTORY_PAGE_SIZE
                 )
-                title = "**🛒 تاریخچه خرید‌های شما**"
-                no_items_message = "سابقه خریدی برای شما ثبت نشده است."
             elif history_type == 'sales':
                 listings, total_count = await crud.get_user_sale_history(
                     db=db_session, user_telegram_id=user.id, page=page, page_size=HISTORY_PAGE_SIZE
                 )
-                title = "**🏷️ تاریخچه فروش‌های شما**"
-                no_items_message = "سابقه فروشی برای شما ثبت نشده است."
             else:
                 raise ValueError("Invalid history type")
+        title, no_items_message = HISTORY_TITLES[history_type]
 
     except Exception as e:
-        logger.error(f"DB error fetching history for user {user.id} (type={history_type}, page={page}): {e}", exc_info=True)
+        logger.error("DB error fetching history for user %s (type=%s, page=%s): %s", user.id, history_type, page, e, exc_info=True)
         await query.edit_message_text("خطا در دریافت تاریخچه. لطفا دوباره تلاش کنید.")
         return
 
     # Format Message
     if total_count == 0:
         no_history_text = f"{title}\n\n{no_items_message}"  # Ensure newlines
-        # Create the back button keyboard even when there's no history
-        inline_keyboard = [[
-            InlineKeyboardButton("🔙 بازگشت به انتخاب نوع", callback_data='history_back_select')
-        ]]
-        reply_markup = InlineKeyboardMarkup(inline_keyboard)
-        # Send the message WITH the keyboard
+        # Send the message WITH the back button keyboard even when there's no history
         await query.edit_message_text(
             no_history_text,
-            reply_markup=reply_markup,
+            reply_markup=HISTORY_BACK_SELECT_MARKUP,
             parse_mode=ParseMode.MARKDOWN
         )
         return
 
     response_parts = [f"{title}\n\n"]
+    rendered_len = len(response_parts[0])
     if not listings and page == 0: # Should be caught by total_count check, but defensive
          response_parts.append(no_items_message)
     else:
@@ -157,10 +164,16 @@ async def handle_history_view(update: Update, context: ContextTypes.DEFAULT_TYPE
                     f"🔢 کد آگهی: `{listing.id}`\n"
                     f"--------------------\n"
                 )
+            # Stop at a row boundary rather than slicing the message, which could cut a Markdown entity
+            rendered_len += len(part)
+            if rendered_len > HISTORY_MESSAGE_MAX_LENGTH:
+                logger.warning("History message for user %s truncated to %s rows.", user.id, len(response_parts) - 1)
+                response_parts.append(HISTORY_TRUNCATED_NOTE)
+                break
             response_parts.append(part)
 
     # Pagination Logic
-    total_pages = math.ceil(total_count / HISTORY_PAGE_SIZE)
+    total_pages = -(-total_count // HISTORY_PAGE_SIZE)  # Ceiling division in integers
     pagination_buttons = []
     if page > 0: # Show Previous button if not on first page
         pagination_buttons.append(
@@ -182,17 +195,11 @@ async def handle_history_view(update: Update, context: ContextTypes.DEFAULT_TYPE
         inline_keyboard.append(pagination_buttons)
 
     # Add Back button to go back to the selection menu (or main menu)
-    inline_keyboard.append([
-         InlineKeyboardButton("🔙 بازگشت به انتخاب نوع", callback_data='history_back_select')
-    ])
+    inline_keyboard.append([HISTORY_BACK_SELECT_BUTTON])
 
     reply_markup = InlineKeyboardMarkup(inline_keyboard)
 
     full_message = "".join(response_parts)
-    # Handle message length just in case
-    if len(full_message) > 4096:
-        logger.warning(f"History message for user {user.id} possibly truncated.")
-        full_message = full_message[:4090] + "\n..."
 
     # Edit the original message (from handle_history or previous page)
     await query.edit_message_text(full_message, parse_mode=ParseMode.MARKDOWN, reply_markup=reply_markup)
@@ -205,19 +212,11 @@ async def handle_history_back_select(update: Update, context: ContextTypes.DEFAU
     user = update.effective_user
     if not query or not user: return
     await query.answer()
-    logger.info(f"User {user.id} going back to history type selection.")
+    logger.info("User %s going back to history type selection.", user.id)
     # Re-display the initial history type selection message and buttons
-    keyboard = [
-        [
-            InlineKeyboardButton("🛒 خرید‌های من", callback_data='history_purchases_0'),
-            InlineKeyboardButton("🏷️ فروش‌های من", callback_data='history_sales_0')
-        ],
-        [InlineKeyboardButton("🔙 بازگشت به منوی اصلی", callback_data='settings_back_main')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
     await query.edit_message_text(
-        "📜 کدام تاریخچه را می‌خواهید مشاهده کنید؟",
-        reply_markup=reply_markup
+        HISTORY_SELECT_TEXT,
+        reply_markup=HISTORY_SELECT_MARKUP
     )
 
 
@@ -233,17 +232,17 @@ async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Check 1: Inside a known conversation? ---
     # (Keep the check from the previous step)
     if context.user_data and ('edu_num' in context.user_data or 'reservation_id' in context.user_data):
-        logger.debug(f"Echo handler ignoring message from user {update.effective_user.id}, likely in conversation.")
+        logger.debug("Echo handler ignoring message from user %s, likely in conversation.", update.effective_user.id)
         return # Do nothing
 
     # Check 2: Is it a known main menu button text? ---
     if message_text and message_text in MAIN_MENU_BUTTON_TEXTS:
-         logger.debug(f"Echo handler ignoring known button text: {message_text}")
+         logger.debug("Echo handler ignoring known button text: %s", message_text)
          return # Do nothing, it was handled by a specific MessageHandler
 
     # Original echo logic for truly unhandled messages
     if message_text:
-        logger.info(f"Received unhandled text message from {update.effective_user.username}: {message_text}")
+        logger.info("Received unhandled text message from %s: %s", update.effective_user.username, message_text)
         await update.message.reply_text(
              f"پیام '{message_text}' دریافت شد. برای نمایش منوی اصلی /start را بزنید."
         )
@@ -258,7 +257,7 @@ async def unexpected_message_handler(update: Update, context: ContextTypes.DEFAU
     """Handles messages that are not expected in the current conversation state."""
     message = update.message
     if message and message.text:
-         logger.warning(f"User {update.effective_user.id} sent unexpected text '{message.text}' during verification.")
+         logger.warning("User %s sent unexpected text '%s' during verification.", update.effective_user.id, message.text)
          await message.reply_text("ورودی نامعتبر است. لطفا طبق دستورالعمل پیش بروید یا /cancel را بزنید.")
     # Decide if state should change or remain the same depending on current state
     # Returning None keeps the state the same implicitly if used directly in ConversationHandler states dict
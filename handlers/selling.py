@@ -29,6 +29,19 @@ PERSIAN_DAYS_MAP = {
     4: "جمعه"     # Friday (datetime.weekday() == 4)
 }
 
+# Static MarkdownV2 replies of the selling flow, escaped once at import
+SELL_CODE_ALREADY_LISTED_TEXT = escape_markdown_v2(
+    "این کد رزرو قبلا برای فروش ثبت شده است یا در حال حاضر در وضعیت فروش قرار دارد."
+)
+SELL_NO_MEALS_DEFINED_TEXT = escape_markdown_v2(
+    "متاسفانه در حال حاضر هیچ نوع غذایی در سیستم تعریف نشده است. لطفا با ادمین تماس بگیرید."
+)
+SELL_CHOOSE_MEAL_TEXT = escape_markdown_v2("لطفا نوع غذای مربوط به این کد را از لیست زیر انتخاب کنید:")
+SELL_CODE_PROCESSING_ERROR_TEXT = escape_markdown_v2("خطا در پردازش کد رزرو.")
+SELL_CODE_CHECK_ERROR_TEXT = escape_markdown_v2("خطا در بررسی کد رزرو. لطفا دوباره تلاش کنید یا /cancel را بزنید.")
+SELL_CREATE_LISTING_ERROR_TEXT = escape_markdown_v2("خطا در ثبت آگهی.")
+SELL_DUPLICATE_LISTING_ERROR_TEXT = escape_markdown_v2("خطا: امکان ثبت آگهی نیست (ممکن است کد تکراری باشد).")
+
 # Sell Food Conversation Handlers
 async def handle_sell_food(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int | None:
     user = update.effective_user
@@ -104,7 +117,7 @@ async def receive_reservation_code(update: Update, context: ContextTypes.DEFAULT
     logger.info(f"User {user.id} entered reservation code: {reservation_code}")
 
     next_state = SELL_ASK_CODE
-    reply_text = "خطا در پردازش کد رزرو."
+    reply_text = SELL_CODE_PROCESSING_ERROR_TEXT
     reply_markup = None
     current_parse_mode = ParseMode.MARKDOWN_V2
 
@@ -114,25 +127,18 @@ async def receive_reservation_code(update: Update, context: ContextTypes.DEFAULT
             code_exists = await crud.check_listing_exists_by_code(db_session, reservation_code)
             if code_exists:
                 logger.warning(f"User {user.id} tried to list code '{reservation_code}' which already exists.")
-                reply_text = escape_markdown_v2(
-                    "این کد رزرو قبلا برای فروش ثبت شده است یا در حال حاضر در وضعیت فروش قرار دارد."
-                )
+                reply_text = SELL_CODE_ALREADY_LISTED_TEXT
                 next_state = ConversationHandler.END
             else:
                 # Fetch available Meals for selection
                 available_meals = await crud.get_meals_for_selling(db_session)  # TODO: Maybe filter by date?
                 if not available_meals:
-                    reply_text = escape_markdown_v2(
-                        "متاسفانه در حال حاضر هیچ نوع غذایی در سیستم تعریف نشده است. لطفا با ادمین تماس بگیرید."
-                    )
+                    reply_text = SELL_NO_MEALS_DEFINED_TEXT
                     next_state = ConversationHandler.END
                 else:
                     context.user_data['university_reservation_code'] = reservation_code
 
-                    # Main instruction text, escaped
-                    instruction_text = escape_markdown_v2(
-                        "لطفا نوع غذای مربوط به این کد را از لیست زیر انتخاب کنید:")
-                    message_parts = [instruction_text, "\n"]  # Add a newline after instruction
+                    message_parts = [SELL_CHOOSE_MEAL_TEXT, "\n"]  # Add a newline after instruction
                     meal_details_for_text_md = []
 
                     for index, meal in enumerate(available_meals):
@@ -184,7 +190,7 @@ async def receive_reservation_code(update: Update, context: ContextTypes.DEFAULT
 
     except Exception as e:
         logger.error(f"Error processing reservation code '{reservation_code}' for user {user.id}: {e}", exc_info=True)
-        reply_text = escape_markdown_v2("خطا در بررسی کد رزرو. لطفا دوباره تلاش کنید یا /cancel را بزنید.")
+        reply_text = SELL_CODE_CHECK_ERROR_TEXT
         next_state = SELL_ASK_CODE
         context.user_data.pop('university_reservation_code', None)
 
@@ -337,7 +343,7 @@ async def confirm_listing(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     logger.info(f"User {user.id} confirmed listing: code={code}, meal={meal_id}, price={price}")
 
-    edit_text = "خطا در ثبت آگهی." # Default error message
+    edit_text = SELL_CREATE_LISTING_ERROR_TEXT # Default error message
     success = False
 
     # Create Listing in DB
@@ -354,7 +360,7 @@ async def confirm_listing(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             edit_text = f"✅ آگهی شما با شماره `{new_listing.id}` ثبت شد\\."
             success = True
         else:
-            edit_text = escape_markdown_v2("خطا: امکان ثبت آگهی نیست (ممکن است کد تکراری باشد).")
+            edit_text = SELL_DUPLICATE_LISTING_ERROR_TEXT
 
     except Exception as e:
         logger.error(f"Error creating listing: {e}", exc_info=True)
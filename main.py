@@ -4,12 +4,16 @@ from datetime import datetime
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import atexit
+try:
+    import uvloop # Faster libuv-based event loop; not available on Windows
+except ImportError:
+    uvloop = None
 import config
 from self_market.db import crud
 from background_tasks import check_pending_listings_timeout, update_meals_from_samad
 from config import BACKGROUND_LISTING_TIMEOUT_CHECK_INTERVAL_MINUTES, PENDING_TIMEOUT_MINUTES
 from bot import TelegramBot
-from self_market.db.session import init_db, get_db_session
+from self_market.db.session import init_db, get_db_session, warm_up_pool
 
 # Logging Setup
 try:
@@ -91,6 +95,12 @@ async def main() -> None:
         logger.error("Database initialization failed. Bot will not start.")
         return # Exit if DB init fails
 
+    # Open the pooled connections up front instead of on the first callbacks
+    try:
+        await warm_up_pool()
+    except Exception as e:
+        logger.error(f"Failed to warm up the DB connection pool: {e}", exc_info=True)
+
     # Synchronize Admin Permissions
     try:
         await synchronize_admin_permissions()
@@ -151,8 +161,10 @@ async def main() -> None:
 # Entry Point
 if __name__ == "__main__":
     logger.info("Starting application...")
+    if uvloop is None:
+        logger.info("uvloop not installed, using the default asyncio event loop.")
     try:
-        asyncio.run(main())
+        asyncio.run(main(), loop_factory=uvloop.new_event_loop if uvloop else None)
     except RuntimeError as e:
         # Suppress common "Event loop is closed" error on Windows during final cleanup
         if "Event loop is closed" in str(e) and "Win" in asyncio.ProactorEventLoop.__module__:
@@ -1,12 +1,14 @@
+import enum
 import logging
 from datetime import datetime, timezone, date, timedelta
 from decimal import Decimal
 from typing import Any, Coroutine
 
-from sqlalchemy import or_, func
+from sqlalchemy import or_, func, delete, exists, event, update, bindparam
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy.orm import selectinload, joinedload
+from sqlalchemy.orm import selectinload, joinedload, raiseload, Session
+from sqlalchemy.orm.attributes import set_committed_value
 from telegram import User as TelegramUser
 from config import PENDING_TIMEOUT_MINUTES
 from .. import models # Import the models.py file from the parent directory (self_market)
@@ -15,6 +17,38 @@ from .. import models # Import the models.py file from the parent directory (sel
 logger = logging.getLogger(__name__)
 
 
+# --- Listings change tracking ---
+# Bumped after every commit that inserted, changed or deleted a listing, so callers can
+# cache views derived from the listings table and know when to rebuild them.
+_listings_version = 0
+
+def get_listings_version() -> int:
+    """Returns a counter that changes whenever committed listing data changes."""
+    return _listings_version
+
+@event.listens_for(Session, "after_flush")
+def _track_listing_flush(session: Session, flush_context) -> None:
+    if any(isinstance(obj, models.Listing) for obj in (*session.new, *session.dirty, *session.deleted)):
+        session.info['listings_changed'] = True
+
+@event.listens_for(Session, "do_orm_execute")
+def _track_listing_bulk_dml(orm_execute_state) -> None:
+    # Bulk delete()/update() statements bypass the flush, e.g. the old-meals cleanup task
+    if (orm_execute_state.is_delete or orm_execute_state.is_update) and \
+            orm_execute_state.bind_mapper is models.Listing.__mapper__:
+        orm_execute_state.session.info['listings_changed'] = True
+
+@event.listens_for(Session, "after_commit")
+def _bump_listings_version(session: Session) -> None:
+    global _listings_version
+    if session.info.pop('listings_changed', False):
+        _listings_version += 1
+
+@event.listens_for(Session, "after_rollback")
+def _reset_listing_changes(session: Session) -> None:
+    session.info.pop('listings_changed', None)
+
+
 async def get_user_by_telegram_id(db: AsyncSession, telegram_id: int, load_listings: bool = False) -> models.User | None:
     """Fetches a user by their Telegram ID."""
     # Access models like models.User, models.Listing, etc.
@@ -125,18 +159,26 @@ async def admin_get_all_users(db: AsyncSession, page: int = 0, page_size: int =
     logger.debug(f"Admin fetching all users, page {page}, page_size {page_size}")
     offset = page * page_size
 
-    # Query for total count
-    count_stmt = select(func.count(models.User.id)).select_from(models.User)
-    count_result = await db.execute(count_stmt)
-    total_count = count_result.scalar_one_or_none() or 0
+    # Page data and total count in one round-trip, ordering by ID for consistent pagination
+    stmt = (
+        select(models.User, func.count().over().label('total_count'))
+        .order_by(models.User.id)
+        .offset(offset)
+        .limit(page_size)
+    )
+    result = await db.execute(stmt)
+    rows = result.all()
 
-    if total_count == 0:
-        return [], 0
+    if rows:
+        users = [row[0] for row in rows]
+        total_count = rows[0].total_count
+    else:
+        # Page past the end (or no users at all): the window count has no row to ride on
+        users = []
+        count_stmt = select(func.count(models.User.id)).select_from(models.User)
+        count_result = await db.execute(count_stmt)
+        total_count = count_result.scalar_one_or_none() or 0
 
-    # Query for the page data, ordering by ID for consistent pagination
-    stmt = select(models.User).order_by(models.User.id).offset(offset).limit(page_size)
-    result = await db.execute(stmt)
-    users = result.scalars().all()
     logger.info(f"Admin fetched {len(users)} users for page {page}. Total users: {total_count}")
     return users, total_count
 
@@ -185,8 +227,8 @@ async def create_meal(db: AsyncSession,
     description: str,
     meal_type: str,
     meal_date: datetime.date,
-    price: Decimal,
-    price_limit: Decimal | None,
+    price: int | Decimal,
+    price_limit: int | Decimal | None,
     is_active: bool = True) -> models.Meal | None:
     """Creates a new meal."""
     new_meal = models.Meal(
@@ -220,33 +262,34 @@ async def get_all_meals(db: AsyncSession) -> list[models.Meal]:
     return result.scalars().all()
 
 
-async def delete_meal(db: AsyncSession, meal_id: int) -> bool:
+async def delete_meal(db: AsyncSession, meal_id: int) -> str | None:
     """
-    Deletes a meal by its ID.
-    Prevents deletion if the meal is referenced by any existing listings.
-    Returns True if deleted, False otherwise.
+    Deletes a meal by its ID in a single DELETE ... RETURNING statement.
+    The meal is only deleted if no listing references it.
+    Returns the deleted meal's description ('' if it had none), or None if nothing was deleted.
     """
-    meal = await get_meal_by_id(db, meal_id)
-    if not meal:
-        logger.warning(f"Meal {meal_id} not found for deletion.")
-        return False
-
-    # Check if the meal is used in any listings
-    stmt_listings = select(models.Listing.id).filter(models.Listing.meal_id == meal_id).limit(1)
-    result_listings = await db.execute(stmt_listings)
-    if result_listings.scalar_one_or_none():
-        logger.warning(f"Cannot delete meal {meal_id} as it is referenced by existing listings. Consider deactivating listings first or marking meal as inactive (if model supported).")
-        return False
-
+    stmt = (
+        delete(models.Meal)
+        .where(
+            models.Meal.id == meal_id,
+            ~exists().where(models.Listing.meal_id == meal_id),
+        )
+        .returning(func.coalesce(models.Meal.description, ''))
+    )
     try:
-        await db.delete(meal)
+        result = await db.execute(stmt)
+        description = result.scalar_one_or_none()
         await db.commit()
-        logger.info(f"Deleted meal {meal_id}")
-        return True
     except Exception as e:
         await db.rollback()
         logger.error(f"Error deleting meal {meal_id}: {e}", exc_info=True)
-        return False
+        return None
+
+    if description is None:
+        logger.warning(f"Meal {meal_id} not deleted (not found or referenced by existing listings).")
+    else:
+        logger.info(f"Deleted meal {meal_id}")
+    return description
 
 async def update_user_verification(
     db: AsyncSession,
@@ -348,83 +391,167 @@ async def create_listing(
         return None
 
 
-async def get_available_listings(db: AsyncSession) -> list[models.Listing]:
-    """Fetches all available listings."""
+async def get_available_listings(db: AsyncSession, limit: int | None = None) -> list[models.Listing]:
+    """
+    Fetches available listings (newest first, at most `limit`) for the buy list, in a single query.
+    Only the seller/meal columns the list renders are loaded; any other relationship
+    access raises instead of silently emitting extra queries.
+    """
     result = await db.execute(
         select(models.Listing)
         .where(models.Listing.status == models.ListingStatus.AVAILABLE)
         .options(
-            joinedload(models.Listing.seller),  # Eager load seller
-            joinedload(models.Listing.meal)  # Eager load meal directly
+            joinedload(models.Listing.seller).load_only(  # Eager load seller
+                models.User.telegram_id, models.User.username, models.User.first_name
+            ),
+            joinedload(models.Listing.meal).load_only(  # Eager load meal directly
+                models.Meal.description, models.Meal.meal_type, models.Meal.date
+            ),
+            raiseload('*'),
         )
         .order_by(models.Listing.created_at.desc())  # Example order
+        .limit(limit)
     )
     return result.scalars().all()
 
-async def get_listing_by_id(db: AsyncSession, listing_id: int) -> models.Listing | None:
-    """Fetches a specific listing by its ID, loading related meal and seller."""
-    result = await db.execute(
-        select(models.Listing)
-        .where(models.Listing.id == listing_id)
-        .options(
-            joinedload(models.Listing.seller), # Need seller for card number & notification
-            joinedload(models.Listing.meal)    # Need meal details
-        )
+# Built once; only the listing_id parameter changes between calls (hot path of every buy/confirm click)
+_LISTING_BY_ID_STMT = (
+    select(models.Listing)
+    .where(models.Listing.id == bindparam('listing_id'))
+    .options(
+        joinedload(models.Listing.seller), # Need seller for card number & notification
+        joinedload(models.Listing.meal),   # Need meal details
+        # No caller reads these; skip their default selectin loads (one extra SELECT each once set)
+        raiseload(models.Listing.buyer),
+        raiseload(models.Listing.pending_buyer_relation),
     )
+)
+
+async def get_listing_by_id(db: AsyncSession, listing_id: int) -> models.Listing | None:
+    """Fetches a specific listing by its ID, loading related meal and seller in the same query."""
+    result = await db.execute(_LISTING_BY_ID_STMT, {'listing_id': listing_id})
     return result.scalar_one_or_none()
 
 
+class PurchaseFailureReason(enum.Enum):
+    """Why set_listing_awaiting_confirmation could not reserve a listing for a buyer."""
+    LISTING_NOT_FOUND = 'listing_not_found'
+    NOT_AVAILABLE = 'not_available'
+    BUYER_NOT_FOUND = 'buyer_not_found'
+    OWN_LISTING = 'own_listing'
+    DB_ERROR = 'db_error'
+
+
 async def set_listing_awaiting_confirmation(
     db: AsyncSession, listing_id: int, buyer_telegram_id: int
-) -> models.Listing | None:
-    """Updates listing status to AWAITING_CONFIRMATION and sets pending_buyer_id."""
+) -> tuple[models.Listing | None, PurchaseFailureReason | None]:
+    """
+    Updates listing status to AWAITING_CONFIRMATION and sets pending_buyer_id.
+    Returns (listing, None) on success, or (listing_or_None, reason) on failure. The listing is
+    returned whenever it was found, so callers can report e.g. its current status without re-querying.
+    """
     logger.info(f"Setting listing {listing_id} to awaiting confirmation for buyer {buyer_telegram_id}")
-    listing = await get_listing_by_id(db, listing_id) # Gets listing with seller+meal loaded
+
+    # Claim the listing in a single conditional UPDATE: the buyer lookup and the own-listing check are
+    # subqueries, and the status condition lets only one of several concurrent buyers win.
+    # The others match no row and fail fast instead of overwriting the first reservation.
+    buyer_id_subquery = (
+        select(models.User.id).where(models.User.telegram_id == buyer_telegram_id).scalar_subquery()
+    )
+    now = datetime.now(timezone.utc)
+    timeout_duration = timedelta(minutes=PENDING_TIMEOUT_MINUTES)
+    claim_stmt = (
+        update(models.Listing)
+        .where(
+            models.Listing.id == listing_id,
+            models.Listing.status == models.ListingStatus.AVAILABLE,
+            buyer_id_subquery.is_not(None), # Buyer must exist (should, if they used /start)
+            models.Listing.seller_id != buyer_id_subquery, # Can't buy own listing
+        )
+        .values(
+            status=models.ListingStatus.AWAITING_CONFIRMATION,
+            pending_buyer_id=buyer_id_subquery, # Store the intended buyer's *DB ID*
+            buyer_id=None, # Ensure final buyer_id is null at this stage
+            pending_until=now + timeout_duration,
+            sold_at=None, # Ensure sold_at is None
+            updated_at=now,
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+    try:
+        result = await db.execute(claim_stmt)
+        claimed = result.rowcount == 1
+        if claimed:
+            await db.commit()
+        else:
+            await db.rollback()
+        # Load the listing with seller+meal: the handler needs them on success, and on failure
+        # the row itself tells which condition failed
+        listing = await get_listing_by_id(db, listing_id)
+    except Exception as e:
+        await db.rollback()
+        logger.error(f"DB error setting listing {listing_id} to awaiting: {e}", exc_info=True)
+        return None, PurchaseFailureReason.DB_ERROR
+
+    if claimed:
+        logger.info(f"Listing {listing_id} status updated to AWAITING_CONFIRMATION.")
+        return listing, None
+
     if not listing:
         logger.warning(f"Listing {listing_id} not found.")
-        return None
-
+        return None, PurchaseFailureReason.LISTING_NOT_FOUND
     if listing.status != models.ListingStatus.AVAILABLE:
         logger.warning(f"Listing {listing_id} is not available (status: {listing.status}). Cannot set to awaiting confirmation.")
-        return None # Already processed or not available
+        return listing, PurchaseFailureReason.NOT_AVAILABLE # Already processed, or claimed by another buyer first
+    if listing.seller and listing.seller.telegram_id == buyer_telegram_id:
+        logger.warning(f"User {buyer_telegram_id} attempted to initiate purchase on own listing {listing_id}.")
+        return listing, PurchaseFailureReason.OWN_LISTING
+    logger.error(f"Buyer user {buyer_telegram_id} not found.")
+    return listing, PurchaseFailureReason.BUYER_NOT_FOUND
 
-    buyer_user = await get_user_by_telegram_id(db, buyer_telegram_id)
-    if not buyer_user:
-        logger.error(f"Buyer user {buyer_telegram_id} not found.")
-        return None # Should not happen if buyer used /start
 
-    if listing.seller_id == buyer_user.id:
-         logger.warning(f"User {buyer_telegram_id} attempted to initiate purchase on own listing {listing_id}.")
-         return None # Or handle as specific error case
+class PendingActionFailureReason(enum.Enum):
+    """Why a pending purchase could not be cancelled by its buyer, rejected or confirmed by its seller."""
+    LISTING_NOT_FOUND = 'listing_not_found'
+    NOT_PENDING = 'not_pending'
+    ALREADY_SOLD = 'already_sold' # Only reported by finalize_listing_sale
+    NOT_PARTICIPANT = 'not_participant' # Not the pending buyer (cancel) / not the seller (reject, confirm)
+    DB_ERROR = 'db_error'
 
-    listing.status = models.ListingStatus.AWAITING_CONFIRMATION
-    listing.pending_buyer_id = buyer_user.id # Store the intended buyer's *DB ID*
-    listing.buyer_id = None # Ensure final buyer_id is null at this stage
-    timeout_duration = timedelta(minutes=PENDING_TIMEOUT_MINUTES)
-    listing.pending_until = datetime.now(timezone.utc) + timeout_duration
-    listing.sold_at = None  # Ensure sold_at is None
 
-    try:
-        db.add(listing) # Ensure tracked by session
-        await db.commit()
-        await db.refresh(listing)
-        # Ensure relationships needed by handler are refreshed
-        await db.refresh(listing, attribute_names=['seller', 'meal'])
-        logger.info(f"Listing {listing_id} status updated to AWAITING_CONFIRMATION.")
-        return listing
-    except Exception as e:
+async def _apply_if_still_pending(db: AsyncSession, listing: models.Listing, **values) -> bool:
+    """
+    Writes `values` to a listing loaded as AWAITING_CONFIRMATION with one conditional UPDATE that
+    only matches while it is still pending for the same buyer, then commits.
+    Of a concurrent cancel/reject/confirm on the same listing only one can match; the others get
+    False (after a rollback) instead of overwriting the winner's state.
+    """
+    stmt = (
+        update(models.Listing)
+        .where(
+            models.Listing.id == listing.id,
+            models.Listing.status == models.ListingStatus.AWAITING_CONFIRMATION,
+            models.Listing.pending_buyer_id == listing.pending_buyer_id,
+        )
+        .values(pending_buyer_id=None, pending_until=None, updated_at=datetime.now(timezone.utc), **values)
+    )
+    result = await db.execute(stmt) # Default sync also applies the values to the loaded listing
+    if result.rowcount != 1:
         await db.rollback()
-        logger.error(f"DB error setting listing {listing_id} to awaiting: {e}", exc_info=True)
-        return None
+        return False
+    await db.commit()
+    set_committed_value(listing, 'pending_buyer_relation', None) # Detach relation in memory
+    return True
 
 
 async def cancel_pending_purchase_by_buyer(
     db: AsyncSession, listing_id: int, buyer_telegram_id: int
-) -> tuple[models.Listing | None, int | None]:
+) -> tuple[models.Listing | None, int | None, PendingActionFailureReason | None]:
     """
     Allows the pending buyer to cancel their purchase request.
     Reverts the listing to AVAILABLE.
-    Returns (updated_listing, seller_telegram_id) or (None, None).
+    Returns (updated_listing, seller_telegram_id, None) or (None, None, reason).
     """
     logger.info(f"Buyer {buyer_telegram_id} attempting to cancel pending purchase for listing {listing_id}")
     try:
@@ -438,47 +565,45 @@ async def cancel_pending_purchase_by_buyer(
 
         if not listing:
             logger.warning(f"Buyer cancellation failed: Listing {listing_id} not found.")
-            return None, None
+            return None, None, PendingActionFailureReason.LISTING_NOT_FOUND
 
         # Verify status is AWAITING_CONFIRMATION
         if listing.status != models.ListingStatus.AWAITING_CONFIRMATION:
             logger.warning(f"Buyer cancellation failed: Listing {listing_id} is not AWAITING_CONFIRMATION (Status: {listing.status}).")
-            return None, None
+            return None, None, PendingActionFailureReason.NOT_PENDING
 
         # Verify the user cancelling is the pending buyer
         if not listing.pending_buyer_relation or listing.pending_buyer_relation.telegram_id != buyer_telegram_id:
             logger.warning(f"Buyer cancellation failed: User {buyer_telegram_id} is not the pending buyer for listing {listing_id}.")
-            return None, None
+            return None, None, PendingActionFailureReason.NOT_PARTICIPANT
 
         # Get seller TG ID for notification before potential detachment
         seller_tg_id = listing.seller.telegram_id if listing.seller else None
 
-        # Perform cancellation
-        listing.status = models.ListingStatus.AVAILABLE # Revert to available
-        listing.pending_buyer_id = None
-        listing.pending_buyer_relation = None # Detach relation in memory
-        listing.pending_until = None
-        listing.cancelled_by_buyer_at = datetime.now(timezone.utc) # Mark cancellation time
-
-        db.add(listing)
-        await db.commit()
-        await db.refresh(listing) # Refresh the listing state
+        # Perform cancellation: revert to available and mark cancellation time
+        if not await _apply_if_still_pending(
+            db, listing,
+            status=models.ListingStatus.AVAILABLE,
+            cancelled_by_buyer_at=datetime.now(timezone.utc),
+        ):
+            logger.warning(f"Buyer cancellation failed: Listing {listing_id} was confirmed, rejected or timed out concurrently.")
+            return None, None, PendingActionFailureReason.NOT_PENDING
         logger.info(f"Successfully cancelled pending purchase for listing {listing_id} by buyer {buyer_telegram_id}.")
-        return listing, seller_tg_id
+        return listing, seller_tg_id, None
 
     except Exception as e:
         await db.rollback()
         logger.error(f"DB error cancelling pending purchase by buyer for listing {listing_id}: {e}", exc_info=True)
-        return None, None
+        return None, None, PendingActionFailureReason.DB_ERROR
 
 
 async def reject_pending_purchase_by_seller(
     db: AsyncSession, listing_id: int, seller_telegram_id: int
-) -> tuple[models.Listing | None, int | None]:
+) -> tuple[models.Listing | None, int | None, PendingActionFailureReason | None]:
     """
     Allows the seller to reject/cancel a pending purchase request.
     Reverts the listing to AVAILABLE.
-    Returns (updated_listing, buyer_telegram_id) or (None, None).
+    Returns (updated_listing, buyer_telegram_id, None) or (None, None, reason).
     """
     logger.info(f"Seller {seller_telegram_id} attempting to reject/cancel pending purchase for listing {listing_id}")
     try:
@@ -492,47 +617,45 @@ async def reject_pending_purchase_by_seller(
 
         if not listing:
             logger.warning(f"Seller rejection failed: Listing {listing_id} not found.")
-            return None, None
+            return None, None, PendingActionFailureReason.LISTING_NOT_FOUND
 
         # Verify ownership
         if not listing.seller or listing.seller.telegram_id != seller_telegram_id:
             logger.warning(f"Seller rejection failed: User {seller_telegram_id} is not the seller of listing {listing_id}.")
-            return None, None
+            return None, None, PendingActionFailureReason.NOT_PARTICIPANT
 
         # Verify status is AWAITING_CONFIRMATION
         if listing.status != models.ListingStatus.AWAITING_CONFIRMATION:
             logger.warning(f"Seller rejection failed: Listing {listing_id} is not AWAITING_CONFIRMATION (Status: {listing.status}).")
-            return None, None
+            return None, None, PendingActionFailureReason.NOT_PENDING
 
         # Get pending buyer TG ID for notification before potential detachment
         buyer_tg_id = listing.pending_buyer_relation.telegram_id if listing.pending_buyer_relation else None
 
-        # Perform rejection (similar to buyer cancellation)
-        listing.status = models.ListingStatus.AVAILABLE # Revert to available
-        listing.pending_buyer_id = None
-        listing.pending_buyer_relation = None # Detach relation in memory
-        listing.pending_until = None
-        listing.rejected_by_seller_at = datetime.now(timezone.utc) # Mark rejection time
-
-        db.add(listing)
-        await db.commit()
-        await db.refresh(listing) # Refresh the listing state
+        # Perform rejection (similar to buyer cancellation): revert to available and mark rejection time
+        if not await _apply_if_still_pending(
+            db, listing,
+            status=models.ListingStatus.AVAILABLE,
+            rejected_by_seller_at=datetime.now(timezone.utc),
+        ):
+            logger.warning(f"Seller rejection failed: Listing {listing_id} was cancelled, confirmed or timed out concurrently.")
+            return None, None, PendingActionFailureReason.NOT_PENDING
         logger.info(f"Successfully rejected pending purchase for listing {listing_id} by seller {seller_telegram_id}.")
-        return listing, buyer_tg_id
+        return listing, buyer_tg_id, None
 
     except Exception as e:
         await db.rollback()
         logger.error(f"DB error rejecting pending purchase by seller for listing {listing_id}: {e}", exc_info=True)
-        return None, None
+        return None, None, PendingActionFailureReason.DB_ERROR
 
 
 async def finalize_listing_sale(
     db: AsyncSession, listing_id: int, confirming_seller_telegram_id: int
-) -> tuple[models.Listing | None, str | None]: # Use tuple for clearer return type hint
+) -> tuple[models.Listing | None, str | None, int | None, PendingActionFailureReason | None]:
     """
     Finalizes the sale after seller confirmation.
     Checks status, seller identity, sets buyer_id, status=SOLD, sold_at.
-    Returns (updated_listing, reservation_code) or (None, None).
+    Returns (updated_listing, reservation_code, buyer_telegram_id, None) or (None, None, None, reason).
     """
     logger.info(f"Seller {confirming_seller_telegram_id} confirming payment for listing {listing_id}")
 
@@ -548,20 +671,22 @@ async def finalize_listing_sale(
     # --- Perform Checks ---
     if not listing:
         logger.warning(f"Listing {listing_id} not found.")
-        return None, None
+        return None, None, None, PendingActionFailureReason.LISTING_NOT_FOUND
     # Use seller loaded via joinedload
     if not listing.seller or listing.seller.telegram_id != confirming_seller_telegram_id:
         # Added more specific log message
         logger.error(f"User {confirming_seller_telegram_id} is not the seller of listing {listing_id} or seller info failed to load.")
-        return None, None
+        return None, None, None, PendingActionFailureReason.NOT_PARTICIPANT
     if listing.status != models.ListingStatus.AWAITING_CONFIRMATION:
         # Added status value to log message
         logger.warning(f"Listing {listing_id} is not awaiting confirmation (Status: {listing.status}). Cannot finalize.")
-        return None, None
+        if listing.status == models.ListingStatus.SOLD:
+            return None, None, None, PendingActionFailureReason.ALREADY_SOLD
+        return None, None, None, PendingActionFailureReason.NOT_PENDING
     if not listing.pending_buyer_id: # This check is important
         logger.error(f"Listing {listing_id} is awaiting confirmation but has no pending_buyer_id!")
         # This indicates a potential issue in the previous step (handle_confirm_purchase)
-        return None, None
+        return None, None, None, PendingActionFailureReason.DB_ERROR
 
     # --- Fetch the Pending Buyer User Separately ---
     # This is the correct way to get the user based on the pending_buyer_id
@@ -569,35 +694,32 @@ async def finalize_listing_sale(
     if not pending_buyer_user:
         logger.error(f"Pending buyer user ID {listing.pending_buyer_id} not found in DB for listing {listing_id}.")
         # Decide how to handle this - maybe revert listing status? For now, fail finalization.
-        return None, None # Cannot finalize without the buyer user object
+        return None, None, None, PendingActionFailureReason.DB_ERROR # Cannot finalize without the buyer user object
 
     # --- Prepare for Update ---
     reservation_code = listing.university_reservation_code # Get code before potential state changes
     pending_buyer_user = listing.pending_buyer_relation  # Get buyer from the loaded relationship
 
-    # --- Finalize the Sale Attributes ---
-    listing.status = models.ListingStatus.SOLD
-    listing.buyer_id = listing.pending_buyer_id     # Set final buyer FK from pending FK
-    listing.buyer = pending_buyer_user              # Associate the fetched buyer object in memory
-    listing.pending_buyer_id = None                 # Clear pending buyer ID
-    listing.pending_buyer_relation = None           # Clear pending buyer relationship in memory
-    listing.sold_at = datetime.now(timezone.utc)
-    listing.pending_until = None  # Clear timeout
-
-    # --- Commit and Refresh ---
+    # --- Finalize the Sale (conditional UPDATE, so a concurrent cancel/reject can't be overwritten) ---
     try:
-        db.add(listing) # Ensure the modified listing object is tracked by the session
-        await db.commit()
-        # Refresh the listing object AND the relationships modified/needed by the caller.
-        # Refreshing 'buyer' ensures the relationship uses the now-committed buyer_id.
-        # Refreshing 'meal' ensures it's up-to-date if accessed after returning.
-        await db.refresh(listing, attribute_names=['buyer', 'meal'])
+        if not await _apply_if_still_pending(
+            db, listing,
+            status=models.ListingStatus.SOLD,
+            buyer_id=listing.pending_buyer_id, # Set final buyer FK from pending FK
+            sold_at=datetime.now(timezone.utc),
+        ):
+            logger.warning(f"Listing {listing_id} was cancelled, rejected or timed out concurrently. Cannot finalize.")
+            return None, None, None, PendingActionFailureReason.NOT_PENDING
+        # 'meal' was joined-loaded above and the buyer is the user fetched above, so the
+        # returned listing is complete without a refresh
+        set_committed_value(listing, 'buyer', pending_buyer_user)
         logger.info(f"Listing {listing_id} finalized as SOLD to buyer ID {listing.buyer_id}.")
-        return listing, reservation_code # Return the updated listing object and the code
+        # Return the updated listing object, the code and who to send it to
+        return listing, reservation_code, pending_buyer_user.telegram_id, None
     except Exception as e:
         await db.rollback()
         logger.error(f"DB error during commit/refresh finalizing sale for listing {listing_id}: {e}", exc_info=True)
-        return None, None
+        return None, None, None, PendingActionFailureReason.DB_ERROR
 
 
 async def update_user_credit_card(db: AsyncSession, telegram_id: int, new_card_number: str) -> bool:
@@ -699,83 +821,72 @@ async def cancel_available_listing_by_seller(db: AsyncSession, listing_id: int,
         return False
 
 
-async def get_user_purchase_history(
+async def _get_sold_history_page(
         db: AsyncSession,
+        party_fk,
+        counterpart,
         user_telegram_id: int,
-        page: int = 0,
-        page_size: int = 5
+        page: int,
+        page_size: int
 ) -> tuple[list[models.Listing], int]:
-    """Fetches paginated purchase history (SOLD listings) for a user."""
-    logger.debug(f"Fetching purchase history for user {user_telegram_id}, page {page}")
-    # Ensure the target user exists and get their DB ID
-    user = await get_user_by_telegram_id(db, user_telegram_id)
-    if not user:
-        return [], 0
-
-    offset = page * page_size
-
-    # Query for total count
-    count_stmt = select(func.count(models.Listing.id)).where(
-        models.Listing.buyer_id == user.id,
-        models.Listing.status == models.ListingStatus.SOLD # Only show successful purchases
-    ).select_from(models.Listing) # Specify the FROM clause for count
-    count_result = await db.execute(count_stmt)
-    total_count = count_result.scalar_one_or_none() or 0
+    """
+    Fetches one page of SOLD listings where `party_fk` points at the user, plus the total count.
 
-    if total_count == 0:
-        return [], 0
+    The user is matched by a join on telegram_id instead of being loaded first: a loaded User
+    would selectin-load every listing and purchase it has. Only the meal and `counterpart`
+    columns the history view renders are loaded; any other relationship access raises.
+    """
+    user_filter = (
+        models.Listing.status == models.ListingStatus.SOLD,  # Only show successful deals
+        models.User.telegram_id == user_telegram_id,
+    )
 
-    # Query for the page data
-    stmt = select(models.Listing).where(
-        models.Listing.buyer_id == user.id,
-        models.Listing.status == models.ListingStatus.SOLD
-    ).options(
+    # Page data and total count in one round-trip: the window count is taken before LIMIT/OFFSET
+    stmt = select(models.Listing, func.count().over()).join(
+        models.User, party_fk == models.User.id
+    ).where(*user_filter).options(
         # Load data needed for display
-        joinedload(models.Listing.meal),
-        joinedload(models.Listing.seller) # Load seller info
+        joinedload(models.Listing.meal).load_only(models.Meal.description, models.Meal.date),
+        joinedload(counterpart).load_only(models.User.username, models.User.first_name),
+        raiseload('*'),
     ).order_by(
-        models.Listing.sold_at.desc() # Newest purchases first
-    ).offset(offset).limit(page_size)
+        models.Listing.sold_at.desc() # Newest first
+    ).offset(page * page_size).limit(page_size)
 
     result = await db.execute(stmt)
-    listings = result.scalars().all()
+    rows = result.all()
+    if rows:
+        return [listing for listing, _ in rows], rows[0][1]
+    if page == 0:
+        return [], 0
+
+    # Past the last page (e.g. a stale pagination button) no row carries the count; ask for it
+    count_stmt = select(func.count(models.Listing.id)).select_from(models.Listing).join(
+        models.User, party_fk == models.User.id
+    ).where(*user_filter)
+    count_result = await db.execute(count_stmt)
+    return [], count_result.scalar_one_or_none() or 0
+
+async def get_user_purchase_history(
+        db: AsyncSession,
+        user_telegram_id: int,
+        page: int = 0,
+        page_size: int = 5
+) -> tuple[list[models.Listing], int]:
+    """Fetches paginated purchase history (SOLD listings) for a user."""
+    logger.debug(f"Fetching purchase history for user {user_telegram_id}, page {page}")
+    listings, total_count = await _get_sold_history_page(
+        db, models.Listing.buyer_id, models.Listing.seller, user_telegram_id, page, page_size
+    )
     logger.debug(f"Found {len(listings)} purchases on page {page} for user {user_telegram_id} (Total: {total_count})")
     return listings, total_count
 
 async def get_user_sale_history(db: AsyncSession, user_telegram_id: int, page: int = 0, page_size: int = 5) -> tuple[list[models.Listing], int]:
     """Fetches paginated sale history (SOLD listings) for a user."""
     logger.debug(f"Fetching sale history for user {user_telegram_id}, page {page}")
-    user = await get_user_by_telegram_id(db, user_telegram_id)
-    if not user:
-        return [], 0
-
-    offset = page * page_size
-
-    # Query for total count
-    count_stmt = select(func.count(models.Listing.id)).where(
-        models.Listing.seller_id == user.id,
-        models.Listing.status == models.ListingStatus.SOLD # Only show successful sales
-    ).select_from(models.Listing)
-    count_result = await db.execute(count_stmt)
-    total_count = count_result.scalar_one_or_none() or 0
-
-    if total_count == 0:
-        return [], 0
-
-    # Query for the page data
-    stmt = select(models.Listing).where(
-        models.Listing.seller_id == user.id,
-        models.Listing.status == models.ListingStatus.SOLD
-    ).options(
-        # Load data needed for display
-        joinedload(models.Listing.meal),
-        joinedload(models.Listing.buyer) # Load buyer info
-    ).order_by(
-        models.Listing.sold_at.desc() # Newest sales first
-    ).offset(offset).limit(page_size)
-
-    result = await db.execute(stmt)
-    listings = result.scalars().all()
+    listings, total_count = await _get_sold_history_page(
+        db, models.Listing.seller_id, models.Listing.buyer, user_telegram_id, page, page_size
+    )
     logger.debug(f"Found {len(listings)} sales on page {page} for user {user_telegram_id} (Total: {total_count})")
     return listings, total_count
 
@@ -7,7 +7,7 @@ from contextlib import asynccontextmanager
 from typing import AsyncGenerator, List, Dict, Any
 from sqlalchemy import text, select
 from datetime import date
-from config import DATABASE_URL
+from config import DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT
 from .base import Base
 from .. import models
 
@@ -18,9 +18,30 @@ db_file_path = "/data/self_market.db"
 
 engine = create_async_engine(
     "sqlite+aiosqlite:///"+DATABASE_URL,
-    echo=False
+    echo=False,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
 )
 
+
+def get_pool_status() -> str:
+    """Returns a one-line summary of the connection pool (size, checked in/out, overflow)."""
+    return engine.pool.status()
+
+
+async def warm_up_pool(connections: int = DB_POOL_SIZE) -> None:
+    """
+    Opens `connections` pooled connections at once and returns them to the pool,
+    so the first burst of callbacks after startup does not pay for connect().
+    """
+    async def _touch() -> None:
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    await asyncio.gather(*(_touch() for _ in range(connections)))
+    logger.info(f"Warmed up DB pool with {connections} connections: {get_pool_status()}")
+
 # Create the async session maker
 async_session_factory = sessionmaker(
     bind=engine,
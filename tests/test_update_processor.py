@@ -0,0 +1,68 @@
+import asyncio
+import unittest
+from datetime import datetime
+
+from telegram import Chat, Message, Update
+
+from bot import PerChatUpdateProcessor
+
+
+def _make_update(update_id: int, chat_id: int) -> Update:
+    return Update(update_id, message=Message(update_id, datetime.now(), Chat(chat_id, Chat.PRIVATE)))
+
+
+class PerChatUpdateProcessorTest(unittest.IsolatedAsyncioTestCase):
+    async def test_flooded_chat_does_not_block_other_chats(self):
+        processor = PerChatUpdateProcessor(max_concurrent_updates=4)
+        release_flood = asyncio.Event()
+        other_chat_done = asyncio.Event()
+        flood_order = []
+
+        async def slow_update(n: int) -> None:
+            await release_flood.wait()
+            flood_order.append(n)
+
+        async def other_chat_update() -> None:
+            other_chat_done.set()
+
+        flood = [
+            asyncio.create_task(processor.process_update(_make_update(n, chat_id=1), slow_update(n)))
+            for n in range(10)  # More than max_concurrent_updates, all from one chat
+        ]
+        await asyncio.sleep(0)
+        other = asyncio.create_task(processor.process_update(_make_update(100, chat_id=2), other_chat_update()))
+
+        # Runs while chat 1's backlog is still blocked
+        await asyncio.wait_for(other_chat_done.wait(), timeout=1)
+        await other
+        self.assertEqual(processor.current_concurrent_updates, 1)  # Only chat 1's head holds a slot
+
+        release_flood.set()
+        await asyncio.gather(*flood)
+        self.assertEqual(flood_order, list(range(10)))  # Chat 1 still processed in order
+        self.assertEqual(processor.current_concurrent_updates, 0)
+
+    async def test_concurrency_limit_applies_across_chats(self):
+        processor = PerChatUpdateProcessor(max_concurrent_updates=2)
+        release = asyncio.Event()
+        started = []
+
+        async def blocking_update(chat_id: int) -> None:
+            started.append(chat_id)
+            await release.wait()
+
+        tasks = [
+            asyncio.create_task(processor.process_update(_make_update(chat_id, chat_id), blocking_update(chat_id)))
+            for chat_id in range(1, 5)
+        ]
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(started), 2)
+
+        release.set()
+        await asyncio.gather(*tasks)
+        self.assertEqual(sorted(started), [1, 2, 3, 4])
+        self.assertEqual(processor._chat_pending, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,6 @@
 import io
 import os
+from functools import lru_cache
 import qrcode
 from PIL import Image, ImageDraw, ImageFont
 import re
@@ -69,16 +70,32 @@ def mask_card_number(card_number: str | None) -> str:
     return f" `{masked_part}{last_four}`" # Return masked number within backticks for markdown
 
 
+# Characters to escape: _ * [ ] ( ) ~ ` > # + - = | { } . !
+# Note: Escaping ` within code blocks is not needed if using single backticks.
+# We escape backticks outside code blocks if they might appear.
+MARKDOWN_V2_ESCAPE_CHARS = r'_*[]()~`>#+-=|{}.!'
+_MARKDOWN_V2_ESCAPE_RE = re.compile(f'([{re.escape(MARKDOWN_V2_ESCAPE_CHARS)}])')
+
+@lru_cache(maxsize=4096)
 def escape_markdown_v2(text: str | None) -> str:
-    """Escapes characters for Telegram MarkdownV2 parsing."""
+    """Escapes characters for Telegram MarkdownV2 parsing. Results are memoized (pure str -> str)."""
     if text is None:
         return ""
-    # Characters to escape: _ * [ ] ( ) ~ ` > # + - = | { } . !
-    # Note: Escaping ` within code blocks is not needed if using single backticks.
-    # We escape backticks outside code blocks if they might appear.
-    escape_chars = r'_*[]()~`>#+-=|{}.!'
-    # Use re.sub to add a backslash before special characters
-    return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text)
+    # Add a backslash before special characters
+    return _MARKDOWN_V2_ESCAPE_RE.sub(r'\\\1', text)
+
+
+@lru_cache(maxsize=2048)
+def render_seller_link_md(telegram_id: int, username: str | None, first_name: str | None) -> str:
+    """
+    MarkdownV2 link to a seller: [@username](https://t.me/username), or
+    [first_name (ID: telegram_id)](tg://user?id=telegram_id) if they have no username.
+    """
+    if username:
+        # The username in the URL itself does not need Markdown escaping
+        return f"[{escape_markdown_v2(f'@{username}')}](https://t.me/{username})"
+    link_text_raw = f"{first_name or 'ناشناس'} (ID: {telegram_id})"
+    return f"[{escape_markdown_v2(link_text_raw)}](tg://user?id={telegram_id})"
 
 
 def format_gregorian_date_to_shamsi(gregorian_date: GregorianDate | datetime | None) -> str:
@@ -88,6 +105,12 @@ def format_gregorian_date_to_shamsi(gregorian_date: GregorianDate | datetime | N
     # If it's a datetime object, get the date part
     if isinstance(gregorian_date, datetime):
         gregorian_date = gregorian_date.date()
+    return _format_date_to_shamsi(gregorian_date)
+
+
+@lru_cache(maxsize=1024)
+def _format_date_to_shamsi(gregorian_date: GregorianDate) -> str:
+    # Memoized per calendar day: many listings and history rows share the same few meal dates
     try:
         j_date = jdatetime.date.fromgregorian(date=gregorian_date)
         return j_date.strftime('%Y/%m/%d')